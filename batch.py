@@ -0,0 +1,153 @@
+import sys, os, io, time, json, contextlib, multiprocessing
+import main as fpp
+from main import main_segment, parse_args, get_cache, VERSION, OUTPUT_SUFFIXES
+from document import Document
+from log import fail, info, warning, Failure
+
+"""
+Batch mode: many input files in one process (or a pool of worker processes).
+
+Manifest format -- one job per line: <input.svg> <label1> <label2> [label3] ...
+paths are relative to the manifest, empty lines and lines starting with # are skipped.
+"""
+
+# fpp options apply to every segment; --jobs runs whole files in parallel
+OPTIONS = dict(fpp.OPTIONS)
+OPTIONS['--summary'] = ('summary', str, None)
+
+USAGE = "usage: fpp-batch [fpp options] [--summary out.json] (<manifest> | <dir> <label1> <label2> [label3] ...)"
+
+
+def read_manifest(fname):
+	""" return -- list of (input.svg, labels) """
+	base = os.path.dirname(fname)
+	jobs = []
+	with open(fname) as f:
+		for i, line in enumerate(f):
+			xs = line.split()
+			if not xs or xs[0].startswith('#'):
+				continue
+			if len(xs) < 3:
+				fail("ERROR: {}:{}: expected: <input.svg> <label1> <label2> ...".format(fname, i+1))
+			jobs.append((os.path.join(base, xs[0]), xs[1:]))
+	return jobs
+
+
+def find_jobs(dname, labels):
+	""" Every svg in 'dname with the same 'labels; outputs of previous runs are skipped """
+	jobs = []
+	for x in sorted(os.listdir(dname)):
+		if x.endswith('.svg') and not x.endswith(tuple(OUTPUT_SUFFIXES.values())):
+			jobs.append((os.path.join(dname, x), labels))
+	return jobs
+
+
+def run_job(job):
+	""" Run all segments of one input file, never raises
+	job -- (input.svg, labels, cache, opts)
+	return -- summary (dict), captured log
+	"""
+	iname, labels, cache, opts = job
+	res = {'file': iname, 'labels': labels, 'status': 'ok', 'error': None, 'segments': []}
+
+	t0 = time.time()
+	out = io.StringIO()
+	with contextlib.redirect_stdout(out):
+		try:
+			doc = Document(iname, ['profil', 'obrys'] + labels, cache)
+		except Failure as e:
+			doc = None
+			res['error'] = e.msg
+		except Exception as e:
+			doc = None
+			res['error'] = "ERROR: {}: {}".format(type(e).__name__, e)
+
+		for a, b in zip(labels[:-1], labels[1:]):
+			if doc is None:
+				break
+
+			seg = {'start': a, 'end': b, 'status': 'ok', 'error': None, 'points': 0, 'outputs': []}
+			t1 = time.time()
+			try:
+				seg.update(main_segment(iname, a, b, doc, opts))
+			except Failure as e:
+				seg['error'] = e.msg
+			except Exception as e:
+				seg['error'] = "ERROR: {}: {}".format(type(e).__name__, e)
+
+			if seg['error'] is not None:
+				seg['status'] = 'failed'
+			seg['time'] = time.time() - t1
+			res['segments'].append(seg)
+
+	if res['error'] is not None or any(seg['status'] != 'ok' for seg in res['segments']):
+		res['status'] = 'failed'
+	res['points'] = sum(seg['points'] for seg in res['segments'])
+	res['time'] = time.time() - t0
+	return res, out.getvalue()
+
+
+def main():
+
+	info("FPP batch version: {}".format(VERSION))
+
+	opts, args = parse_args(sys.argv[1:], OPTIONS)
+
+	if len(args) == 1 and os.path.isfile(args[0]):
+		jobs = read_manifest(args[0])
+	elif len(args) >= 3 and os.path.isdir(args[0]):
+		jobs = find_jobs(args[0], args[1:])
+	else:
+		info(USAGE)
+		sys.exit(0)
+
+	cache = get_cache(opts)
+	jobs = [(iname, labels, cache, opts) for iname, labels in jobs]
+	
+	t0 = time.time()
+	results = []
+
+	if opts['jobs'] > 1 and len(jobs) > 1:
+		pool = multiprocessing.Pool(min(opts['jobs'], len(jobs)))
+		runs = pool.imap(run_job, jobs)
+	else:
+		pool = None
+		runs = map(run_job, jobs)
+
+	for res, log in runs:
+		print(log, end='')
+		if res['status'] != 'ok':
+			for seg in res['segments']:
+				if seg['error'] is not None:
+					warning("{}: segment {}-{} failed: {}".format(res['file'], seg['start'], seg['end'], seg['error']))
+			if res['error'] is not None:
+				warning("{}: failed: {}".format(res['file'], res['error']))
+		results.append(res)
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+	failed = sum(res['status'] != 'ok' for res in results)
+	summary = {
+		'version': VERSION,
+		'ok': len(results) - failed,
+		'failed': failed,
+		'time': time.time() - t0,
+		'jobs': results,
+	}
+
+	if opts['summary'] is None:
+		print(json.dumps(summary, indent=1))
+	else:
+		with open(opts['summary'], 'w') as f:
+			json.dump(summary, f, indent=1)
+		info("summary written to {}".format(opts['summary']))
+
+	info("{} jobs done, {} failed".format(len(results), failed))
+	if failed:
+		sys.exit(-1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,260 @@
+import sys, os, time, json, math, platform, subprocess
+import numpy as np
+from main import parse_args, VERSION
+from path import Vec, Poly, Line, Bezier3, intersect_line_line, intersect_lines, intersect_poly_line, intersect_poly_poly, flattern_bezier3
+from parse_svg import accept_path
+from reader import Reader
+from log import fail, info, warning
+
+"""
+Microbenchmarks of the geometry kernels.
+
+Each kernel is timed at several sizes n (best of --repeat runs) and the scaling
+exponent k of time ~ n^k is fitted, so quadratic behaviour stands out (k near 2).
+
+With --startup the interpreter startup of the entry points is measured instead,
+with the cost of each import taken from python -X importtime.
+"""
+
+def sizes(s):
+	return [int(x) for x in s.split(',')]
+
+OPTIONS = {
+	'--sizes': ('sizes', sizes, [1000, 2000, 4000, 8000]),
+	'--repeat': ('repeat', int, 3),
+	'--curvature': ('curvature', float, 0.2),
+	'--only': ('only', str, None),
+	'--out': ('out', str, None),
+	'--compare': ('compare', str, None),
+	'--startup': ('startup', None, False),
+	'--top': ('top', int, 10),
+}
+
+USAGE = "usage: python bench.py [--sizes 1000,2000,...] [--repeat N] [--curvature C] [--only kernel] [--out results.json] [--compare old.json] [--startup [--top N]]"
+
+
+def make_outline(n, curvature=0.2, r=100.0, center=(0.0, 0.0)):
+	""" Closed wavy outline with 'n sections; 'curvature is the relative wave amplitude """
+	a = np.linspace(0, 2*math.pi, n + 1)
+	rr = r * (1 + curvature * np.sin(7 * a))
+	xs = np.stack([center[0] + rr * np.cos(a), center[1] + rr * np.sin(a)], axis=1)
+	xs[-1] = xs[0]
+	return Poly(xs)
+
+
+def make_profile(n, curvature=0.2, w=200.0, h=40.0):
+	""" Open profile (a monotone bump along x) with 'n sections """
+	x = np.linspace(0, w, n + 1)
+	y = h * np.sin(math.pi * x / w) * (1 + curvature * np.sin(20 * math.pi * x / w))
+	return Poly(np.stack([x, y], axis=1))
+
+
+def make_path_data(n, curvature=0.2, seed=0):
+	""" Path 'd string with 'n relative cubic segments """
+	rng = np.random.default_rng(seed)
+	cs = rng.uniform(-1, 1, (n, 6)) * (1 + 10 * curvature)
+	return "M 0,0 " + " ".join("c {:.4f},{:.4f} {:.4f},{:.4f} {:.4f},{:.4f}".format(*c) for c in cs)
+
+
+def make_curve(n, curvature=0.2):
+	""" Cubic curve and tolerance for which it flatterns into about 'n sections """
+	b = Bezier3(Vec(0.0, 0.0), Vec(100.0, 100.0 * curvature), Vec(0.0, 100.0), Vec(100.0, 100.0))
+	return b, b.get_max_d2() / (8.0 * n * n)
+
+
+def setup_intersect_line_line(n, curvature):
+	rng = np.random.default_rng(0)
+	ps = rng.uniform(-1, 1, (n, 4, 2))
+	def run():
+		for x1, x2, y1, y2 in ps:
+			intersect_line_line(x1, x2, y1, y2)
+	return run
+
+def setup_intersect_lines(n, curvature):
+	rng = np.random.default_rng(0)
+	ps = rng.uniform(-1, 1, (4, n, 2))
+	def run():
+		intersect_lines(*ps)
+	return run
+
+def setup_intersect_poly_line(n, curvature):
+	p = make_profile(n, curvature)
+	p.get_index()
+	lines = [Line(Vec(x, 0.0), Vec(x, -1.0)) for x in np.linspace(1, 199, 20)]
+	def run():
+		for line in lines:
+			intersect_poly_line(p, line)
+	return run
+
+def setup_intersect_poly_poly(n, curvature):
+	a = make_outline(n, curvature)
+	b = make_outline(n, curvature, r=80.0, center=(50.0, 0.0))
+	def run():
+		a.index = None
+		b.index = None
+		intersect_poly_poly(a, b)
+	return run
+
+def setup_get_point(n, curvature):
+	p = make_outline(n, curvature)
+	ds = np.random.default_rng(0).uniform(0, p.get_length(), 200)
+	def run():
+		for d in ds:
+			p.get_point(d)
+	return run
+
+def setup_flattern_bezier3(n, curvature):
+	b, tolerance = make_curve(n, curvature)
+	def run():
+		flattern_bezier3(b, tolerance)
+	return run
+
+def setup_accept_path(n, curvature):
+	d = make_path_data(n, curvature)
+	def run():
+		accept_path(Reader(d))
+	return run
+
+
+KERNELS = {
+	'intersect_line_line': setup_intersect_line_line,
+	'intersect_lines': setup_intersect_lines,
+	'intersect_poly_line': setup_intersect_poly_line,
+	'intersect_poly_poly': setup_intersect_poly_poly,
+	'Poly.get_point': setup_get_point,
+	'flattern_bezier3': setup_flattern_bezier3,
+	'accept_path': setup_accept_path,
+}
+
+
+# entry point -> command line (run from the directory of this file)
+STARTUP = {
+	'fpp usage': ['client.py'],
+	'import main': ['-c', 'import main'],
+	'import daemon': ['-c', 'import daemon'],
+}
+
+
+def parse_importtime(err):
+	""" Imports from python -X importtime output
+	return -- list of (module, self us, cumulative us) in import order
+	
+	>>> parse_importtime("import time: self [us] | cumulative | imported package\\nimport time:       442 |       1837 |   os\\n")
+	[('os', 442, 1837)]
+	"""
+	rs = []
+	for line in err.splitlines():
+		if not line.startswith('import time:'):
+			continue
+		xs = line[len('import time:'):].split('|')
+		if len(xs) == 3 and xs[0].strip().isdigit():
+			rs.append((xs[2].strip(), int(xs[0]), int(xs[1])))
+	return rs
+
+
+def measure_startup(args, repeat):
+	""" Best wall time of 'repeat interpreter runs and imports of the last one """
+	cwd = os.path.dirname(os.path.abspath(__file__))
+	env = dict(os.environ, FPP_NO_DAEMON='1')
+	best = float('inf')
+	for _ in range(repeat):
+		t = time.perf_counter()
+		p = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd, env=env, capture_output=True, text=True)
+		best = min(best, time.perf_counter() - t)
+	return best, parse_importtime(p.stderr)
+
+
+def run_startup(repeat, top):
+	res = {}
+	for name, args in STARTUP.items():
+		t, imports = measure_startup(args, repeat)
+		res[name] = {'time': t, 'imports': imports}
+		info("{:22} {:.4f}s  {} modules, numpy {}".format(name, t, len(imports), 'loaded' if any(m == 'numpy' for m, _, _ in imports) else 'not loaded'))
+		for m, us, cum in sorted(imports, key=lambda x: -x[1])[:top]:
+			info("  {:36} self {:8.1f}ms  cumulative {:8.1f}ms".format(m, us / 1000.0, cum / 1000.0))
+	return res
+
+
+def measure(run, repeat):
+	""" Best wall time of 'repeat runs """
+	best = float('inf')
+	for _ in range(repeat):
+		t = time.perf_counter()
+		run()
+		best = min(best, time.perf_counter() - t)
+	return best
+
+
+def get_exponent(ns, ts):
+	""" Slope of log(time) against log(size)
+
+	>>> round(get_exponent([10, 20, 40], [1.0, 4.0, 16.0]), 6)
+	2.0
+	"""
+	if len(ns) < 2:
+		return None
+	return float(np.polyfit(np.log(ns), np.log(np.maximum(ts, 1e-9)), 1)[0])
+
+
+def run_benchmarks(names, ns, repeat, curvature):
+	res = {}
+	for name in names:
+		ts = []
+		for n in ns:
+			ts.append(measure(KERNELS[name](n, curvature), repeat))
+		res[name] = {'sizes': ns, 'times': ts, 'exponent': get_exponent(ns, ts)}
+		info("{:22} k={:5.2f}  ".format(name, res[name]['exponent'] or 0.0) + " ".join("{}:{:.4f}s".format(n, t) for n, t in zip(ns, ts)))
+	return res
+
+
+def compare(res, old):
+	""" Print time ratios (new/old) for kernels and sizes present in both runs """
+	for name, r in res.items():
+		if name not in old:
+			continue
+		o = old[name]
+		ratios = ["{}:{:.2f}x".format(n, t / ot) for n, t, on, ot in zip(r['sizes'], r['times'], o['sizes'], o['times']) if n == on and ot > 0]
+		info("{:22} k {:5.2f} -> {:5.2f}  ".format(name, o['exponent'] or 0.0, r['exponent'] or 0.0) + " ".join(ratios))
+
+
+def main():
+	opts, args = parse_args(sys.argv[1:], OPTIONS)
+	if args:
+		info(USAGE)
+		sys.exit(0)
+
+	if opts['startup']:
+		res = run_startup(opts['repeat'], opts['top'])
+		if opts['out'] is not None:
+			with open(opts['out'], 'w') as f:
+				json.dump({'version': VERSION, 'python': platform.python_version(), 'startup': res}, f, indent=1)
+			info("written to {}".format(opts['out']))
+		return
+
+	names = list(KERNELS)
+	if opts['only'] is not None:
+		if opts['only'] not in KERNELS:
+			fail("ERROR: unknown kernel: {!r}; one of: {}".format(opts['only'], ", ".join(KERNELS)))
+		names = [opts['only']]
+
+	res = run_benchmarks(names, opts['sizes'], opts['repeat'], opts['curvature'])
+
+	if opts['compare'] is not None:
+		with open(opts['compare']) as f:
+			compare(res, json.load(f)['kernels'])
+
+	if opts['out'] is not None:
+		with open(opts['out'], 'w') as f:
+			json.dump({
+				'version': VERSION,
+				'python': platform.python_version(),
+				'numpy': np.__version__,
+				'curvature': opts['curvature'],
+				'repeat': opts['repeat'],
+				'kernels': res,
+			}, f, indent=1)
+		info("written to {}".format(opts['out']))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,141 @@
+import os, json, hashlib, zlib, tempfile
+import numpy as np
+from log import fail, info, warning
+
+"""
+On-disk cache of flatterned paths.
+
+Entry <key>.json holds the metadata (max error, vertex count, crc32 of the data),
+<key>-xs.npy the vertices (N,2) and <key>-ls.npy the section lengths (N-1,).
+Arrays are memory mapped on load. Entries that fail validation are removed.
+Failed writes and evictions are only warned about: the cache never fails a run.
+"""
+
+# bump when the flatterning or the entry format changes
+CACHE_VERSION = 1
+
+
+class Cache:
+	def __init__(self, dname, max_bytes=256 * 2**20):
+		"""
+		dname -- cache directory (created if missing)
+		max_bytes -- size limit, least recently used entries are evicted above it
+		"""
+		self.dname = dname
+		self.max_bytes = max_bytes
+		os.makedirs(dname, exist_ok=True)
+		self.evict()
+
+	def get_key(self, d, tolerance, to_mm, adaptive):
+		""" Hash of path data 'd and flatterning parameters """
+		h = hashlib.sha256()
+		h.update(json.dumps([CACHE_VERSION, repr(tolerance), repr(to_mm), bool(adaptive)]).encode('utf-8'))
+		h.update(d.encode('utf-8'))
+		return h.hexdigest()
+
+	def get_names(self, key):
+		base = os.path.join(self.dname, key)
+		return base + '.json', base + '-xs.npy', base + '-ls.npy'
+
+	def load(self, key):
+		""" return -- (err, xs, ls) or None when missing, stale or corrupt """
+		meta_name, xs_name, ls_name = self.get_names(key)
+		if not os.path.exists(meta_name):
+			return None
+
+		try:
+			with open(meta_name) as f:
+				meta = json.load(f)
+
+			xs = np.load(xs_name, mmap_mode='r')
+			ls = np.load(ls_name, mmap_mode='r')
+
+			ok = (
+				meta['version'] == CACHE_VERSION and
+				xs.dtype == np.float64 and xs.shape == (meta['n'], 2) and
+				ls.dtype == np.float64 and ls.shape == (max(meta['n'] - 1, 0),) and
+				zlib.crc32(ls, zlib.crc32(xs)) == meta['crc']
+			)
+		except (OSError, ValueError, KeyError, TypeError):
+			ok = False
+
+		if not ok:
+			warning("cache: ignoring invalid entry {}".format(key))
+			self.remove(key)
+			return None
+
+		os.utime(meta_name)
+		return meta['err'], xs, ls
+
+	def save(self, key, err, xs, ls):
+		xs = np.ascontiguousarray(xs, dtype=np.float64)
+		ls = np.ascontiguousarray(ls, dtype=np.float64)
+		meta = {
+			'version': CACHE_VERSION,
+			'n': len(xs),
+			'err': float(err),
+			'crc': zlib.crc32(ls, zlib.crc32(xs)),
+		}
+
+		# data first, metadata last; each written to a temporary file and renamed
+		meta_name, xs_name, ls_name = self.get_names(key)
+		try:
+			for name, data in ((xs_name, xs), (ls_name, ls)):
+				self.write(name, lambda f: np.save(f, data))
+			self.write(meta_name, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+		except OSError as e:
+			warning("cache: cannot save entry {}: {}".format(key, e))
+			return
+
+		self.evict()
+
+	def write(self, name, dump):
+		""" Write file 'name with dump(f) through a temporary file unique to this writer,
+		so concurrent saves of the same entry do not collide
+		"""
+		fd, tmp_name = tempfile.mkstemp(dir=self.dname, prefix=os.path.basename(name) + '.', suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				dump(f)
+			os.replace(tmp_name, name)
+		except OSError:
+			try:
+				os.remove(tmp_name)
+			except OSError:
+				pass
+			raise
+
+	def remove(self, key):
+		for name in self.get_names(key):
+			try:
+				os.remove(name)
+			except OSError:
+				pass
+
+	def evict(self):
+		""" Remove least recently used entries until the cache fits in max_bytes """
+		try:
+			xs = os.listdir(self.dname)
+		except OSError as e:
+			warning("cache: cannot evict: {}".format(e))
+			return
+
+		entries = {}
+		for x in xs:
+			name = os.path.join(self.dname, x)
+			key = x.split('.')[0].split('-')[0]
+			try:
+				st = os.stat(name)
+			except OSError:
+				continue
+			size, used = entries.get(key, (0, 0))
+			if x.endswith('.json'):
+				used = st.st_mtime
+			entries[key] = (size + st.st_size, used)
+
+		total = sum(size for size, _ in entries.values())
+		for key, (size, _) in sorted(entries.items(), key=lambda kv: kv[1][1]):
+			if total <= self.max_bytes:
+				break
+			self.remove(key)
+			total -= size
@@ -0,0 +1,67 @@
+import sys, os
+from options import VERSION, USAGE, parse_args
+from log import fail, info, warning
+
+"""
+Thin fpp client: forwards the command line to a running daemon (see daemon.py)
+and falls back to running fpp in this process when there is none.
+
+Imports nothing heavy: usage is printed without loading numpy and with a
+daemon running a call costs one interpreter start and one round trip. 
+Set FPP_NO_DAEMON=1 to always run in process.
+"""
+
+def get_socket_name():
+	""" Default daemon socket, one per user; FPP_SOCKET overrides it """
+	tmp = os.environ.get('TMPDIR') or '/tmp'
+	return os.environ.get('FPP_SOCKET') or os.path.join(tmp, 'fpp-{}.sock'.format(os.getuid()))
+
+
+def send(msg, sname=None):
+	""" Send request 'msg (dict) to the daemon
+	return -- response (dict) or None when no daemon is listening or it failed to answer
+	"""
+	import json, socket
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		with s:
+			s.connect(sname or get_socket_name())
+			s.sendall(json.dumps(msg).encode('utf-8') + b"\n")
+			s.shutdown(socket.SHUT_WR)
+			data = []
+			while 1:
+				x = s.recv(65536)
+				if not x:
+					break
+				data.append(x)
+		return json.loads(b"".join(data).decode('utf-8'))
+	except (OSError, ValueError):
+		# no daemon, or it died mid-request (reset, empty or partial reply)
+		return None
+
+
+def main():
+	argv = sys.argv[1:]
+
+	# same checks as main.main, without importing it
+	opts, args = parse_args(argv)
+	if len(args) < 3:
+		info("FPP version: {}".format(VERSION))
+		info(USAGE)
+		sys.exit(0)
+
+	r = None
+	if not os.environ.get('FPP_NO_DAEMON'):
+		r = send({'argv': argv, 'cwd': os.getcwd()})
+
+	if r is None:
+		import main as fpp
+		fpp.main(argv)
+		return
+
+	print(r['log'], end='')
+	sys.exit(r['exit'])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,126 @@
+import sys, os, io, json, signal, socketserver, contextlib, collections, traceback
+import main as fpp
+from main import parse_args
+from document import Document
+from client import get_socket_name, send
+from log import fail, info, warning
+import timing
+
+"""
+fpp daemon: keeps parsed documents and their flatterned paths in memory between runs.
+
+Listens on a unix socket (see client.get_socket_name). A request is one line of
+json {"argv": [...], "cwd": "..."}, the response {"exit", "log", "results"} where
+results lists segments with their output files. Requests are served one at a time.
+Documents are kept in an LRU keyed by path, mtime and size, so an edited drawing
+is loaded again.
+"""
+
+OPTIONS = {
+	'--socket': ('socket', str, None),
+	'--max-docs': ('max_docs', int, 8),
+}
+
+USAGE = "usage: fpp-daemon [--socket PATH] [--max-docs N]"
+
+
+class DocumentCache:
+	""" Least recently used documents, at most 'max_docs """
+	def __init__(self, max_docs):
+		self.max_docs = max_docs
+		self.docs = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get_key(self, iname):
+		st = os.stat(iname)
+		return os.path.abspath(iname), st.st_mtime_ns, st.st_size
+
+	def load(self, iname, ids, cache):
+		""" Same as Document(iname, ids, cache) but reused while the file is unchanged """
+		try:
+			key = self.get_key(iname)
+		except OSError as e:
+			fail("ERROR: cannot open {!r}: {}".format(iname, e.strerror))
+
+		doc = self.docs.get(key)
+		if doc is None:
+			self.misses += 1
+			# whole document: later requests may ask for other labels
+			doc = Document(iname, None, cache)
+			self.docs[key] = doc
+			while len(self.docs) > self.max_docs:
+				self.docs.popitem(last=False)
+		else:
+			self.hits += 1
+			info("document: {!r} reused".format(iname))
+			self.docs.move_to_end(key)
+
+		doc.cache = cache
+		return doc
+
+
+def run(argv, docs):
+	""" Run one fpp command line with documents from 'docs
+	return -- response (dict)
+	"""
+	out = io.StringIO()
+	code = 0
+	results = []
+	with contextlib.redirect_stdout(out):
+		try:
+			results = fpp.main(argv, docs.load)
+		except SystemExit as e:
+			code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+		except Exception:
+			traceback.print_exc(file=out)
+			code = 1
+		finally:
+			timing.disable()
+			timing.reset()
+	return {'exit': code, 'log': out.getvalue(), 'results': results or []}
+
+
+class Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		try:
+			msg = json.loads(self.rfile.readline().decode('utf-8'))
+			os.chdir(msg['cwd'])
+			r = run(msg['argv'], self.server.docs)
+		except (ValueError, KeyError, OSError) as e:
+			r = {'exit': 1, 'log': "ERROR: bad request: {}\n".format(e), 'results': []}
+		self.wfile.write(json.dumps(r).encode('utf-8'))
+
+
+def stop(signum, frame):
+	raise KeyboardInterrupt
+
+
+def main():
+	opts, args = parse_args(sys.argv[1:], OPTIONS)
+	if args:
+		info(USAGE)
+		sys.exit(0)
+
+	sname = opts['socket'] or get_socket_name()
+	if os.path.exists(sname):
+		if send({'argv': [], 'cwd': os.getcwd()}, sname) is not None:
+			fail("ERROR: daemon already running on {}".format(sname))
+		os.remove(sname)
+
+	server = socketserver.UnixStreamServer(sname, Handler)
+	server.docs = DocumentCache(opts['max_docs'])
+	info("FPP daemon version {} listening on {}".format(fpp.VERSION, sname))
+	signal.signal(signal.SIGTERM, stop)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(sname)
+		info("daemon stopped; documents: {} loaded, {} reused".format(server.docs.misses, server.docs.hits))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,130 @@
+import math
+import xml.etree.ElementTree as ET
+from parse_svg import accept_mm, accept_path, accept_viewBox, make_path
+from path import Poly
+from log import fail, info, warning
+from reader import Reader
+import timing
+
+
+def get_conversion_mm(vb, w_mm, h_mm):
+	"""
+	return -- to_mm, mm_to
+	"""
+	x0,y0,dx,dy = vb
+
+	to_mmx = w_mm/dx
+	to_mmy = h_mm/dy
+	assert math.isclose(to_mmx, to_mmy), (to_mmx, to_mmy)
+
+	to_mm = to_mmx
+	mm_to = dx/w_mm
+	return to_mm, mm_to
+
+
+def read_poly(x, name, tolerance, adaptive=False, cache=None, to_mm=None):
+	""" Flatterned path element 'x
+	cache -- optional Cache; entries are keyed by path data, tolerance, 'to_mm and 'adaptive
+	"""
+	d = x.get('d')
+	if cache is not None:
+		key = cache.get_key(d, tolerance, to_mm, adaptive)
+		hit = cache.load(key)
+		if hit is not None:
+			err, xs, ls = hit
+			return Poly(xs, ls)
+	
+	beziers = make_path(accept_path(Reader(d)), as_set=True)
+	err, vertices = beziers.flattern(tolerance, name, adaptive)
+	poly = Poly(vertices)
+	
+	if cache is not None:
+		cache.save(key, err, poly.xs, poly.ls)
+	return poly
+
+
+def load_elements(iname, wanted):
+	""" Stream the svg keeping only elements with ids in 'wanted; other elements
+	are cleared as soon as they end and reading stops once every id is found
+	return -- root (without children of interest), dict id -> element
+	"""
+	wanted = set(wanted)
+	root = None
+	ids = {}
+	for event, x in ET.iterparse(iname, events=('start', 'end')):
+		if event == 'start':
+			if root is None:
+				root = x
+			ident = x.get('id')
+			if ident in wanted and ident not in ids:
+				ids[ident] = x
+				if len(ids) == len(wanted):
+					break
+		elif x is not root and ids.get(x.get('id')) is not x:
+			x.clear()
+	return root, ids
+
+
+class Document:
+	""" Input svg parsed once: root attributes, unit conversion,
+	elements indexed by id and flatterned paths cached by (id, tolerance)
+	
+	ids -- when given, only elements with these ids are kept (see load_elements)
+	cache -- optional Cache of flatterned paths shared between runs
+	"""
+	def __init__(self, iname, ids=None, cache=None):
+		info("opening: {!r}".format(iname))
+
+		self.iname = iname
+		with timing.stage('xml'):
+			if ids is None:
+				self.root = ET.parse(iname).getroot()
+				self.ids = {}
+				for x in self.root.iter():
+					ident = x.get('id')
+					if ident is not None and ident not in self.ids:
+						self.ids[ident] = x
+			else:
+				self.root, self.ids = load_elements(iname, ids)
+
+		self.vb = accept_viewBox(Reader(self.root.get('viewBox')))
+		self.w_mm = accept_mm(Reader(self.root.get('width')))
+		self.h_mm = accept_mm(Reader(self.root.get('height')))
+		self.to_mm, self.mm_to = get_conversion_mm(self.vb, self.w_mm, self.h_mm)
+
+		info("width : {:.1f}mm".format(self.w_mm))
+		info("height: {:.1f}mm".format(self.h_mm))
+
+		self.polys = {}
+		self.cache = cache
+
+	def __getstate__(self):
+		""" Pickled without the xml tree: only paths already in the cache 
+		and the path data (see get_path_data) are shipped """
+		state = dict(self.__dict__)
+		state['root'] = None
+		state['ids'] = {}
+		state['path_data'] = {ident: x.get('d') for ident, x in self.ids.items()}
+		return state
+
+	def find(self, ident):
+		""" Element with id 'ident or None """
+		return self.ids.get(ident)
+
+	def get_path_data(self, ident):
+		""" Path data ('d attribute) of element 'ident or None """
+		x = self.find(ident)
+		if x is not None:
+			return x.get('d')
+		return getattr(self, 'path_data', {}).get(ident)
+	
+	def get_poly(self, ident, tolerance, adaptive=False):
+		""" Flatterned path with id 'ident or None """
+		key = (ident, tolerance, adaptive)
+		if key not in self.polys:
+			x = self.find(ident)
+			if x is None:
+				self.polys[key] = None
+			else:
+				self.polys[key] = read_poly(x, ident, tolerance, adaptive, self.cache, self.to_mm)
+		return self.polys[key]
@@ -0,0 +1,77 @@
+import time
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+"""
+Plots of a segment: live view (SHOW_GUI) and headless png overlay.
+
+Imported on demand by main (matplotlib is slow to import and optional).
+shapes -- list of (ident, vertices (N,2)) drawn as polylines
+segs -- station lines from obrys to profil (M,2,2), already decimated
+"""
+
+
+def draw_shapes(ax, shapes):
+	for ident, xs in shapes:
+		ax.plot(xs[:,0], xs[:,1], label=ident, linewidth=0.8)
+	ax.set_aspect('equal')
+	# svg y axis points down
+	if not ax.yaxis_inverted():
+		ax.invert_yaxis()
+
+
+class Viewer:
+	""" Interactive window replaying computed stations in batches
+
+	Station lines go to one LineCollection and the value to one text artist,
+	both updated in place and blitted over a cached background, so a frame
+	costs the same regardless of the number of stations shown.
+	"""
+	def __init__(self, shapes):
+		import matplotlib.pyplot as plt
+		self.plt = plt
+		plt.ion()
+		self.fig, self.ax = plt.subplots()
+		draw_shapes(self.ax, shapes)
+
+		self.lines = LineCollection([], colors='red', linewidths=0.5, animated=True)
+		self.ax.add_collection(self.lines)
+		self.label = self.ax.text(0, 0, '', verticalalignment='center', backgroundcolor='white', animated=True)
+
+		plt.show(block=False)
+		self.fig.canvas.draw()
+		self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+	def play(self, segs, values_mm, fps, batch):
+		""" Show 'batch more stations per frame, at most 'fps frames per second """
+		canvas = self.fig.canvas
+		for a in range(batch, len(segs) + batch, batch):
+			t = time.perf_counter()
+			b = min(a, len(segs))
+
+			self.lines.set_segments(segs[:b])
+			x, y = segs[b-1, 1]
+			self.label.set_position((x, y))
+			self.label.set_text("{:.1f}mm".format(values_mm[b-1]))
+
+			canvas.restore_region(self.background)
+			self.ax.draw_artist(self.lines)
+			self.ax.draw_artist(self.label)
+			canvas.blit(self.fig.bbox)
+			canvas.flush_events()
+
+			dt = 1.0 / fps - (time.perf_counter() - t)
+			if dt > 0:
+				time.sleep(dt)
+
+
+def save_overlay_png(oname, shapes, segs, dpi):
+	""" Headless overlay (no window, Agg canvas) """
+	fig = Figure(figsize=(12, 8))
+	FigureCanvasAgg(fig)
+	ax = fig.add_subplot()
+	draw_shapes(ax, shapes)
+	ax.add_collection(LineCollection(segs, colors='red', linewidths=0.3))
+	ax.legend(loc='upper right', fontsize='small')
+	fig.savefig(oname, dpi=dpi)
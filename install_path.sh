@@ -1,2 +1,6 @@
-echo "python3 `pwd`/main.py \"\$@\"" > /usr/local/bin/fpp
+echo "python3 `pwd`/client.py \"\$@\"" > /usr/local/bin/fpp
 chmod +x /usr/local/bin/fpp
+echo "python3 `pwd`/batch.py \"\$@\"" > /usr/local/bin/fpp-batch
+chmod +x /usr/local/bin/fpp-batch
+echo "python3 `pwd`/daemon.py \"\$@\"" > /usr/local/bin/fpp-daemon
+chmod +x /usr/local/bin/fpp-daemon
@@ -1,4 +1,8 @@
-import sys
+class Failure(SystemExit):
+	""" Raised by fail; exits the program with -1 unless caught """
+	def __init__(self, msg):
+		SystemExit.__init__(self, -1)
+		self.msg = msg
 
 def warning(msg):
 	print("WARNING: "+msg)
@@ -8,5 +12,4 @@ def info(msg):
 	
 def fail(msg):
 	print(msg)
-	sys.exit(-1)
-
+	raise Failure(msg)
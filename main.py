@@ -1,13 +1,13 @@
 import sys
-from parse_svg import accept_mm, accept_path, accept_viewBox, make_path
-from path import distance, Vec, Bezier1, project, Poly, Line
-from path import intersect_poly_poly, intersect_poly_line, flattern_bezier_list
-import xml.etree.ElementTree as ET
-from log import fail, info, warning
-from reader import Reader
+from options import VERSION, OUTPUT_FORMATS, OPTIONS, USAGE, parse_args
+from path import Vec, Line, intersect_poly_poly, simplify, concat_ranges
+from document import Document
+from cache import Cache
+from log import fail, info, warning, Failure
 import math
-
-VERSION = '0.4.0'
+import io, json, hashlib, contextlib
+import timing
+import numpy as np
 
 TOLERANCE_MM = 0.1
 STEP_MM = 0.5
@@ -15,10 +15,23 @@ STEP_MM = 0.5
 SHOW_GUI = 0
 PRINT_OUTPUT = 0
 
+# plots (SHOW_GUI, --overlay): every n-th station drawn, live view stations per frame and frame rate, png resolution
+GUI_DECIMATE = 10
+GUI_BATCH = 20
+GUI_FPS = 25
+GUI_DPI = 150
+
+# flattern curves with non-uniform sections (fewer vertices)
+ADAPTIVE_FLATTERN = 0
+
 LINE_THICKNESS_MM = 0.18
 
-if SHOW_GUI:
-	import matplotlib.pyplot as plt
+# points formatted at once when writing svg path data
+SVG_CHUNK_POINTS = 4096
+
+# adaptive sampling (--max-error): initial and smallest distance between stations
+ADAPTIVE_MAX_STEP_MM = 10.0
+ADAPTIVE_MIN_STEP_MM = 0.01
 
 """
 Note on units: every variable stores value in [u] (unless postfix _mm), use mm_to and to_mm for input, output
@@ -36,7 +49,7 @@ TODO: set STEP size show output ^
 # TODO: thinner line in output <- set to mm ?
 # TODO: add cover start indicator?
 
-# TODO: Alert on negative values on the profil -- check h value in calc_value
+# TODO: Alert on negative values on the profil -- check h value in calc_values
 
 # TODO: think of some sanity check on output? -> 
             check last point == first point   if applicable
@@ -81,47 +94,63 @@ OUTPUT_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 
 
 def get_aabb(ps):
-	min_x = +2**30
-	min_y = +2**30
-	max_x = -2**30
-	max_y = -2**30
-	
-	for x,y in ps:
-		if x > max_x:
-			max_x = x
-		if x < min_x:
-			min_x = x
-			
-		if y > max_y:
-			max_y = y
-		if y < min_y:
-			min_y = y
-			
-	return Vec(min_x,min_y),Vec(max_x,max_y)
+	"""
+	ps -- (N,2) array of points
+	return -- min corner, max corner
+	
+	>>> a, b = get_aabb(np.array([[1.0, 5.0], [-2.0, 3.0], [0.0, 4.0]]))
+	>>> print(a, b)
+	[-2.  3.] [ 1.  5.]
+	"""
+	ps = np.asarray(ps, dtype=float).reshape(-1, 2)
+	return ps.min(axis=0), ps.max(axis=0)
+
+
+def write_path_data(f, parts):
+	""" Write 'parts (arrays of points) to 'f as svg path data; coordinates are 
+	formatted in bulk, SVG_CHUNK_POINTS points at a time 
 	
+	>>> f = io.StringIO()
+	>>> write_path_data(f, [np.array([[0.0, 1.0], [2.0, 3.0]]), np.array([[4.5, -1.0]])])
+	>>> f.getvalue()
+	'M 0.000000,1.000000 2.000000,3.000000 4.500000,-1.000000'
+	"""
+	f.write("M")
+	for ps in parts:
+		ps = np.asarray(ps, dtype=float).reshape(-1, 2)
+		for a in range(0, len(ps), SVG_CHUNK_POINTS):
+			chunk = ps[a:a+SVG_CHUNK_POINTS]
+			f.write((" %.6f,%.6f" * len(chunk)) % tuple(chunk.ravel().tolist()))
 
+
+@timing.timed('write_shape_to_svg')
 def write_shape_to_svg(oname, ident, points, viewbox, to_mm):
 	"""
 	oname -- svg filename
-	points -- path points
+	points -- (N,2) array of path points or a list of such arrays written one after another
 	viewbox -- (x,y,dx,dy)
 	to_mm -- conversion ratio	
 	"""
 
 	x,y,dx,dy = viewbox
-	path =  "M " + " ".join("{:.6f},{:.6f}".format(*p) for p in points)
-	
-	with open(oname, 'wb') as f:
-		f.write(
-			OUTPUT_TEMPLATE.format(
-				path = path,
-				width = "{:.6f}mm".format(dx * to_mm),
-				height = "{:.6f}mm".format(dy * to_mm),
-				viewbox = "{:.6f} {:.6f} {:.6f} {:.6f}".format(*viewbox),
-				ident = ident,
-				line_thickness_mm = LINE_THICKNESS_MM,
-			).encode('utf-8')
+	if isinstance(points, np.ndarray):
+		points = [points]
+	
+	head, tail = [
+		part.format(
+			width = "{:.6f}mm".format(dx * to_mm),
+			height = "{:.6f}mm".format(dy * to_mm),
+			viewbox = "{:.6f} {:.6f} {:.6f} {:.6f}".format(*viewbox),
+			ident = ident,
+			line_thickness_mm = LINE_THICKNESS_MM,
 		)
+		for part in OUTPUT_TEMPLATE.split('{path}')
+	]
+	
+	with open(oname, 'w', encoding='utf-8', newline='') as f:
+		f.write(head)
+		write_path_data(f, points)
+		f.write(tail)
 		
 	info("written to {}".format(oname))
 
@@ -143,10 +172,7 @@ def save_side_svg(ps, oname, mar, to_mm):
 	
 	assert len(ps) > 0
 	
-	max_y = 0
-	for x,y in ps:
-		if y > max_y:
-			max_y = y
+	max_y = max(0, ps[:,1].max())
 	
 	max_x = ps[-1][0]
 	min_x = ps[ 0][0]
@@ -155,14 +181,11 @@ def save_side_svg(ps, oname, mar, to_mm):
 	h = max_y
 				
 	
-	
-	ps.append((max_x,0))
-	ps.append((min_x,0))
-	ps.append(ps[0])      # close
+	close = np.array([(max_x,0), (min_x,0), ps[0]])
 	
 	vb = (min_x-mar,0-mar,w+2*mar,h+2*mar)
 	
-	write_shape_to_svg(oname = oname, ident='side', points = ps, viewbox = vb, to_mm = to_mm)
+	write_shape_to_svg(oname = oname, ident='side', points = [ps, close], viewbox = vb, to_mm = to_mm)
 	
 
 
@@ -171,160 +194,499 @@ def save_side_svg(ps, oname, mar, to_mm):
 
 
 
-def get_conversion_mm(vb, w_mm, h_mm):
-	"""
-	return -- to_mm, mm_to
+OVERLAY_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg
+   xmlns="http://www.w3.org/2000/svg"
+   viewBox="{viewbox}"
+   version="1.1">
+"""
+
+OVERLAY_PATH = """  <path
+     id="{ident}"
+     style="fill:none;stroke:{color};stroke-width:{line_thickness_mm}mm"
+     d=\""""
+
+
+@timing.timed('save_overlay_svg')
+def save_overlay_svg(oname, viewbox, shapes, segs):
+	""" Segment overlay in the coordinates of the input drawing
+	shapes -- list of (ident, vertices (N,2)) drawn as polylines
+	segs -- station lines (M,2,2)
 	"""
-	x0,y0,dx,dy = vb
-	
-	to_mmx = w_mm/dx
-	to_mmy = h_mm/dy
-	assert math.isclose(to_mmx, to_mmy), (to_mmx, to_mmy)
-	
-	to_mm = to_mmx
-	mm_to = dx/w_mm
-	return to_mm, mm_to
-	
+	with open(oname, 'w', encoding='utf-8', newline='') as f:
+		f.write(OVERLAY_TEMPLATE.format(viewbox = "{:.6f} {:.6f} {:.6f} {:.6f}".format(*viewbox)))
+		for ident, xs in shapes:
+			f.write(OVERLAY_PATH.format(ident=ident, color='#000000', line_thickness_mm=LINE_THICKNESS_MM))
+			write_path_data(f, [xs])
+			f.write('" />\n')
+		
+		f.write(OVERLAY_PATH.format(ident='stations', color='#ff0000', line_thickness_mm=LINE_THICKNESS_MM / 2))
+		segs = segs.reshape(-1, 4)
+		for a in range(0, len(segs), SVG_CHUNK_POINTS):
+			chunk = segs[a:a+SVG_CHUNK_POINTS]
+			f.write(("M %.6f,%.6f %.6f,%.6f " * len(chunk)) % tuple(chunk.ravel().tolist()))
+		f.write('" />\n</svg>\n')
 	
+	info("written to {}".format(oname))
 
+
+def decimate(n, k):
+	""" Indices of every 'k-th of 'n stations, the last one included
 	
-def read_poly_from_svg_path(root, name, tolerance):
-	x = root.find(".//*[@id='"+name+"']")
-	if x != None:
-		beziers = make_path(accept_path(Reader(x.get('d'))))
-		err, vertices = flattern_bezier_list(beziers, tolerance, name)
-		return Poly(vertices)
-		
-	else:		
-		return None
+	>>> print(decimate(7, 3))
+	[0 3 6]
+	>>> print(decimate(8, 3))
+	[0 3 6 7]
+	"""
+	return np.unique(np.concatenate([np.arange(0, n, k), [n - 1]]))
 
 
+@timing.timed('save_stations')
+def save_stations(oname, fmt, stations):
+	""" Station arrays in mm, one row per station, columns STATION_COLUMNS
+	fmt -- 'npy (one (N,5) float64 array, loadable with np.load(.., mmap_mode='r')),
+		'npz (one array per column) or 'csv
+	return -- filename
+	"""
+	if fmt == 'npy':
+		np.save(oname, stations)
+	elif fmt == 'npz':
+		np.savez(oname, **dict(zip(STATION_COLUMNS, stations.T)))
+	else:
+		np.savetxt(oname, stations, fmt='%.17g', delimiter=',', header=','.join(STATION_COLUMNS), comments='')
+	info("written to {}".format(oname))
+	return oname
 
 
+def get_gui():
+	""" gui module, imported on first use (needs matplotlib) """
+	try:
+		import gui
+	except ImportError as e:
+		fail("ERROR: matplotlib is required for SHOW_GUI and --overlay png: {}".format(e))
+	return gui
 
 
+def get_stations(pos, end, delta, step, length):
+	""" Station positions, same sequence as produced by stepping 'pos by 'step
+	pos -- start position along obrys
+	end -- end position along obrys
+	delta -- distance from start to end along obrys
+	length -- length of obrys (positions wrap around it)
+	return -- totals, poss (arrays)
+	"""
+	n = int(delta / step) + 2
+	steps = np.full(n, step)
+	steps[0] = 0.0
 
+	totals = np.cumsum(steps)
+	steps[0] = pos
+	poss = np.cumsum(steps)
 
+	keep = totals < delta
+	totals = totals[keep]
+	poss = poss[keep]
+	poss = np.where(poss > length, poss - length, poss)
 
-def show(point_obrys, point_profil, value_mm):
-	vis1, = Bezier1(point_obrys, point_profil).render(plt)		
-	vis2 = plt.text(
-		x=point_profil[0] + 15, 
-		y=point_profil[1], 
-		s="{:.1f}mm".format(value_mm),
-		verticalalignment='center',
-		backgroundcolor='white',
-		#bbox=dict(facecolor='white', alpha=0.8),
-		#size=12
-	)
-	
-	plt.show()
-	plt.pause(0.001)
-	#plt.waitforbuttonpress(timeout=-1)
-	
-	vis1.remove()
-	vis2.remove()
+	# value at the end
+	return np.append(totals, delta), np.append(poss, end)
+
+
+class ProfileTable:
+	""" Profil transformed once into odcinek coordinates, for O(log m) lookup 
+	of the profil point above any point of odcinek
+	
+	us -- positions of section ends along odcinek (0 at its start, 1 at its end), strictly increasing
+
+	Sections with no extent along odcinek (zero-length, or perpendicular to it
+	like vertical walls) are dropped: orthogonal lines never cross them.
+	A profil turning back along odcinek has no unique point above some of its
+	points and fails up front.
+	
+	>>> from path import Poly
+	>>> t = ProfileTable(Poly([Vec(0,0), Vec(1,1), Vec(1,1), Vec(3,1), Vec(4,0)]), Line(Vec(0,0), Vec(4,0)))
+	>>> print(t.us)
+	[ 0.    0.25  0.75  1.  ]
+	>>> cover_x, points = t.lookup(np.array([0.125, 0.5]))
+	>>> print(points)
+	[[ 0.5  0.5]
+	 [ 2.   1. ]]
+	>>> t = ProfileTable(Poly([Vec(0,190), Vec(0,150), Vec(200,150), Vec(200,190)]), Line(Vec(0,190), Vec(200,190)))
+	>>> print(t.us)
+	[ 0.  1.]
+	>>> cover_x, points = t.lookup(np.array([0.0, 0.5, 1.0]))
+	>>> print(cover_x)
+	[  40.  140.  240.]
+	"""
+	def __init__(self, profil, odcinek):
+		self.x0 = odcinek.p0
+		self.s = odcinek.get_dir()
+		self.ort = Vec(self.s[1], -self.s[0])
+		
+		us = self.get_positions(profil.xs)
+		dus = np.round(np.diff(us), 12)
+
+		back = np.flatnonzero(dus < 0)
+		if len(back):
+			fail("ERROR: profil is not monotone along odcinek (turns back at {:.1f}% of its length)".format(
+				100.0 * profil.cs[back[0]] / profil.get_length()))
+
+		nz = dus > 0
+		if not nz.any():
+			fail("ERROR: profil has zero length along odcinek")
+
+		self.xs = profil.xs[:-1][nz]
+		self.vs = profil.vs[nz]
+		self.ls = profil.ls[nz]
+		self.cs = profil.cs[:-1][nz]
+		self.us = np.concatenate([us[:-1][nz], us[-1:]])
+	
+	def get_positions(self, points):
+		""" Positions of the projections of 'points onto odcinek """
+		return (points - self.x0).dot(self.s) / self.s.dot(self.s)
+	
+	def get_crossings(self, hs):
+		""" Profil vertices passed between consecutive positions 'hs along odcinek
+		return -- interval indices j, fractions f in (0,1) of [hs[j], hs[j+1]]
+		
+		>>> from path import Poly
+		>>> t = ProfileTable(Poly([Vec(0,0), Vec(1,1), Vec(3,1), Vec(4,0)]), Line(Vec(0,0), Vec(4,0)))
+		>>> j, f = t.get_crossings(np.array([0.0, 0.5, 1.0]))
+		>>> print(j, f)
+		[0 1] [ 0.5  0.5]
+		"""
+		lo = np.minimum(hs[:-1], hs[1:])
+		hi = np.maximum(hs[:-1], hs[1:])
+		i0 = np.searchsorted(self.us, lo, side='right')
+		ns = np.maximum(np.searchsorted(self.us, hi, side='left') - i0, 0)
+		j = np.repeat(np.arange(len(ns)), ns)
+		us = self.us[concat_ranges(i0, ns)]
+		return j, (us - hs[j]) / (hs[j+1] - hs[j])
+	
+	def lookup(self, hs):
+		""" 
+		hs -- positions along odcinek
+		return -- cover_x (distances along profil), profil points (N,2)
+		"""
+		i = np.clip(np.searchsorted(self.us, hs, side='right') - 1, 0, len(self.ls) - 1)
+		ts = np.round((hs - self.us[i]) / (self.us[i+1] - self.us[i]), 12)
+		if ((ts < 0) | (ts > 1)).any():
+			fail('ERROR: unique intersection point of profil and orto_line is undefined')
+		
+		return self.cs[i] + ts * self.ls[i], self.xs[i] + ts[:,None] * self.vs[i]
 
 
+def calc_values(poss, obrys, table):
+	""" Values and cover points of stations
+	poss -- array of positions along obrys
+	table -- ProfileTable of profil and odcinek
+	return -- values (N,), cover points (N,2)
+	"""
+	points_obrys = obrys.get_points(poss)
 
+	# project onto odcinek
+	hs = table.get_positions(points_obrys)
+	points_odcinek = table.x0 + hs[:,None] * table.s
 
-def calc_value(pos, obrys, profil, odcinek, to_mm):
-	##TODO: Calculate sidewall and cover point
-	##TODO: (height, dist) -- sidewall height, distance along obrys from start point
-	
-	
-	odcinek_dir = odcinek.get_dir()
-	ort_odcinek = Vec(odcinek_dir[1], -odcinek_dir[0])
+	cover_x, points_profil = table.lookup(hs)
+
+	values = np.hypot(*(points_profil - points_odcinek).T)
+	cover_h = (points_obrys - points_odcinek).dot(table.ort) / math.sqrt(table.ort.dot(table.ort))
+
+	return values, np.stack([cover_x, cover_h], axis=1)
+
+
+def sample_adaptive(pos, delta, obrys, table, max_err, max_step, min_step):
+	""" Stations placed so that linear interpolation of values and cover points 
+	between neighbours stays within 'max_err
 	
+	Starts from stations 'max_step apart, obrys vertices (corners of the 
+	outline) and the points whose projection onto odcinek meets a profil vertex,
+	always including start and end. Values and cover points are linear between 
+	these kinks. Each interval is then split at 1/4, 1/2, 3/4 while any of these 
+	points deviates from the interpolation more than 3/4 'max_err and the 
+	interval is longer than 'min_step.
+	return -- totals, poss, values, covers (arrays ordered by totals)
 	
-	point_obrys = obrys.get_point(pos)
+	>>> from path import Poly
+	>>> spike = Poly([Vec(0,0), Vec(46.5,0), Vec(47,50), Vec(47.5,0), Vec(100,0)])
+	>>> table = ProfileTable(spike, Line(Vec(0,0), Vec(100,0)))
+	>>> obrys = Poly([Vec(0,-10), Vec(60,-20), Vec(100,-10)])
+	>>> totals, poss, values, covers = sample_adaptive(0.0, obrys.get_length(), obrys, table, 0.1, 10.0, 0.01)
+	>>> dense = np.linspace(0.0, obrys.get_length(), 100001)
+	>>> dv, dc = calc_values(dense, obrys, table)
+	>>> len(totals) < 100, np.abs(np.interp(dense, totals, values) - dv).max() <= 0.1
+	(True, True)
+	"""
+	length = obrys.get_length()
+	def get_positions(totals):
+		poss = pos + totals
+		return np.where(poss > length, poss - length, poss)
+	
+	n = max(1, int(math.ceil(delta / max_step)))
+	corners = np.mod(obrys.cs - pos, length)
+	corners = corners[(corners > 0) & (corners < delta)]
+	totals = np.unique(np.concatenate([np.linspace(0.0, delta, n + 1), corners]))
+	
+	# obrys is straight between these, so its projection is linear there
+	hs = table.get_positions(obrys.get_points(get_positions(totals)))
+	j, f = table.get_crossings(hs)
+	totals = np.unique(np.concatenate([totals, totals[j] + f * (totals[j+1] - totals[j])]))
+	values, covers = calc_values(get_positions(totals), obrys, table)
+	ys = np.column_stack([values, covers])
+	
+	fs = np.array([0.25, 0.5, 0.75])
+	while 1:
+		t0 = totals[:-1]
+		dt = totals[1:] - totals[:-1]
+		open_ = dt > min_step
+		if not open_.any():
+			break
+		
+		tests = (t0[open_,None] + dt[open_,None] * fs).ravel()
+		tv, tc = calc_values(get_positions(tests), obrys, table)
+		tys = np.column_stack([tv, tc]).reshape(-1, len(fs), 3)
+		
+		y0 = ys[:-1][open_]
+		y1 = ys[1:][open_]
+		lin = y0[:,None,:] + fs[None,:,None] * (y1 - y0)[:,None,:]
+		bad = (np.abs(tys - lin) > 0.75 * max_err).any(axis=(1,2))
+		if not bad.any():
+			break
+		
+		totals = np.concatenate([totals, tests.reshape(-1, len(fs))[bad].ravel()])
+		ys = np.concatenate([ys, tys[bad].reshape(-1, 3)])
+		order = np.argsort(totals, kind='stable')
+		totals = totals[order]
+		ys = ys[order]
 	
-	point_odcinek, _ = project(point = point_obrys, line = odcinek)
+	return totals, get_positions(totals), ys[:,0], ys[:,1:]
+
+
+
+
+import os.path
+
+
+
+# columns of the station outputs (npy, npz, csv)
+STATION_COLUMNS = ('total_mm', 'value_mm', 'cover_x_mm', 'cover_h_mm', 'pos_mm')
+
+# files written per segment, named <input>-<start>-<end><suffix>; batch does not take them for inputs
+OUTPUT_SUFFIXES = {
+	'side': '-side.svg',
+	'top': '-top.svg',
+	'overlay-svg': '-overlay.svg',
+	'overlay-png': '-overlay.png',
+	'stations-npy': '-stations.npy',
+	'stations-npz': '-stations.npz',
+	'stations-csv': '-stations.csv',
+	'profile-json': '-profile.json',
+	'profile-text': '-profile.txt',
+	'cprofile': '-stations.prof',
+	'stamp': '.fpp',
+}
+
+
+def get_output_name(name, start_label, end_label, kind):
+	"""
+	>>> get_output_name('a/b', 'A', 'B', 'side')
+	'a/b-A-B-side.svg'
+	"""
+	return "{}-{}-{}{}".format(name, start_label, end_label, OUTPUT_SUFFIXES[kind])
+
+
+def main(argv=None, load=Document):
+	""" Run fpp with command line 'argv (sys.argv[1:] when None)
+	load -- load(iname, ids, cache) -> Document; the daemon passes its document cache here
+	return -- list of segment results (see main_segment)
+	"""
 	
-	orto_line = Line(point_odcinek, point_odcinek + ort_odcinek)
-	orto_unit = orto_line.get_length()
+	info("FPP version: {}".format(VERSION))
 	
-	cover_x,cover_y = None, None
+	opts, args = parse_args(sys.argv[1:] if argv is None else argv)
 	
+	if len(args) < 3:
+		info(USAGE)
+		sys.exit(0)	
 	
-	ths = intersect_poly_line(poly = profil, line = orto_line)
+	if opts['profile']:
+		timing.enable()
 	
-	#print(profil.xs, orto_line.p0, orto_line.p1)
+	iname = args[0]
+	labels = args[1:]
+	doc = load(iname, ['profil', 'obrys'] + labels, get_cache(opts))
 	
-	#print(ths)
-	if len(ths) == 1:
-		t,h = ths[0]
-		point_profil = profil.get_point(t)
-
-		# assert all hs are having the same sign
-		h
-		
-		cover_x = t
-		
+	if opts['jobs'] > 1:
+		results = main_parallel(iname, labels, doc, opts)
 	else:
-		fail('ERROR: unique intersection point of profil and orto_line is undefined')
-		
-	
-	_, cover_h = project(point = point_obrys, line = orto_line)
-	
-			
-	value = distance(point_odcinek, point_profil)
+		results = []
+		a = labels[0]
+		for x in labels[1:]:
+			b = x
+			results.append(main_segment(iname, a, b, doc, opts))
+			a = b
 	
-	if SHOW_GUI:
-		show(point_obrys, point_profil, value * to_mm)
-	
-	return value, Vec(cover_x, cover_h * orto_unit)
+	rebuilt = ["{}-{}".format(r['start'], r['end']) for r in results if not r['skipped']]
+	skipped = ["{}-{}".format(r['start'], r['end']) for r in results if r['skipped']]
+	info("segments rebuilt: {} {}".format(len(rebuilt), " ".join(rebuilt)))
+	info("segments skipped: {} {}".format(len(skipped), " ".join(skipped)))
+	return results
 
 
 
-import os.path
+def get_fingerprint(doc, start_label, end_label, opts):
+	""" Hash of everything the outputs of a segment depend on: path data of 
+	profil, obrys and both labels, units, parameters and the program version
+	"""
+	inputs = {
+		'version': VERSION,
+		'paths': [doc.get_path_data(ident) for ident in ('profil', 'obrys', start_label, end_label)],
+		'viewbox': list(doc.vb),
+		'size_mm': [doc.w_mm, doc.h_mm],
+		'params': [
+			STEP_MM, TOLERANCE_MM, ADAPTIVE_FLATTERN, LINE_THICKNESS_MM, 
+			ADAPTIVE_MAX_STEP_MM, ADAPTIVE_MIN_STEP_MM, GUI_DECIMATE, GUI_DPI,
+		],
+		'opts': [opts[key] for key in ('max_error', 'simplify', 'formats', 'overlay')],
+	}
+	return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_stamp(fname, fingerprint):
+	""" Stamp written by a previous run, or None when missing, stale or any of its outputs is gone 
+	return -- {'fingerprint', 'points', 'outputs'} 
+	"""
+	try:
+		with open(fname) as f:
+			stamp = json.load(f)
+		ok = stamp['fingerprint'] == fingerprint and all(os.path.exists(x) for x in stamp['outputs'])
+	except (OSError, ValueError, KeyError, TypeError):
+		return None
+	return stamp if ok else None
+
+
+def write_stamp(fname, fingerprint, points, outputs):
+	with open(fname + '.tmp', 'w') as f:
+		json.dump({'fingerprint': fingerprint, 'points': points, 'outputs': outputs}, f, indent=1)
+	os.replace(fname + '.tmp', fname)
+
+
+def get_cache(opts):
+	""" Cache selected by --cache or None """
+	if opts['cache'] is None:
+		return None
+	return Cache(opts['cache'], int(opts['cache_mb'] * 2**20))
 
 
 
-def main():
+worker_doc = None
+
+def init_worker(doc):
+	global worker_doc
+	worker_doc = doc
+	# loading was done (and recorded) in the parent
+	timing.reset()
 	
-	info("FPP version: {}".format(VERSION))
+
+def run_segment(task):
+	""" Run one segment in a worker process
+	task -- (iname, start_label, end_label, opts)
+	return -- (start_label, end_label, error message or None, captured log, result)
+	"""
+	iname, a, b, opts = task
+	out = io.StringIO()
+	err = None
+	res = None
+	with contextlib.redirect_stdout(out):
+		try:
+			res = main_segment(iname, a, b, worker_doc, opts)
+		except Failure as e:
+			err = e.msg
+		except Exception as e:
+			err = "ERROR: {}: {}".format(type(e).__name__, e)
+	return a, b, err, out.getvalue(), res
+
+
+def main_parallel(iname, labels, doc, opts):
+	""" Run segments of consecutive 'labels in a pool of opts['jobs'] worker processes
+	
+	Geometry is flatterned here and shipped to each worker once. Logs are 
+	printed in segment order; a failed segment does not stop the others.
+	return -- list of segment results
+	"""
+	tolerance = TOLERANCE_MM * doc.mm_to
+	for ident in ['profil', 'obrys']:
+		doc.get_poly(ident, tolerance, ADAPTIVE_FLATTERN)
+	for ident in labels:
+		# a bad marker is reported by the segments using it
+		with contextlib.redirect_stdout(io.StringIO()):
+			try:
+				doc.get_poly(ident, tolerance, ADAPTIVE_FLATTERN)
+			except Failure:
+				pass
+	
+	tasks = [(iname, a, b, opts) for a, b in zip(labels[:-1], labels[1:])]
+	
+	import multiprocessing
+	
+	failed = []
+	results = []
+	with multiprocessing.Pool(min(opts['jobs'], len(tasks)), initializer=init_worker, initargs=(doc,)) as pool:
+		for a, b, err, log, res in pool.imap(run_segment, tasks):
+			print(log, end='')
+			if err is not None:
+				warning("segment {}-{} failed: {}".format(a, b, err))
+				failed.append((a, b))
+			else:
+				results.append(res)
 	
-	if len(sys.argv) < 4:
-		info("usage: fpp <input.svg> <label1> <label2> [label3] ...")
-		sys.exit(0)	
+	if failed:
+		fail("ERROR: {} of {} segments failed: {}".format(
+			len(failed), len(tasks), " ".join("{}-{}".format(a, b) for a, b in failed)
+		))
+	return results
 	
-	iname = sys.argv[1]
 	
-	a = sys.argv[2]
-	for x in sys.argv[3:]:
-		b = x
-		main_segment(iname, a, b)
-		a = b
+def main_segment(iname, start_label, end_label, doc=None, opts=None):
+	"""
+	doc -- Document of 'iname, shared between segments of one run (loaded when None)
+	opts -- options as returned by parse_args (defaults when None)
+	"""
 	
+	name = os.path.splitext(iname)[0]
 	
-def main_segment(iname, start_label, end_label):
+	if opts is None:
+		opts, _ = parse_args([])
 	
-	name = os.path.splitext(iname)[0]
+	if opts['profile']:
+		timing.enable()
 	
-	info("opening: {!r}".format(iname))
+	if doc is None:
+		doc = Document(iname, ['profil', 'obrys', start_label, end_label])
 	
-	tree = ET.parse(iname)
-	root = tree.getroot()
+	# outputs of the previous run are kept when none of their inputs changed;
+	# the live view and profiling need the segment to actually run
+	stamp_name = get_output_name(name, start_label, end_label, 'stamp')
+	fingerprint = get_fingerprint(doc, start_label, end_label, opts)
+	if not (opts['force'] or SHOW_GUI or opts['profile'] or opts['cprofile']):
+		stamp = read_stamp(stamp_name, fingerprint)
+		if stamp is not None:
+			info("segment {}-{}: up to date, skipped".format(start_label, end_label))
+			return {'start': start_label, 'end': end_label, 'points': stamp['points'], 'outputs': stamp['outputs'], 'skipped': True}
 	
-	vb = accept_viewBox(Reader(root.get('viewBox')))
-	w_mm = accept_mm(Reader(root.get('width')))
-	h_mm = accept_mm(Reader(root.get('height')))
-	to_mm, mm_to = get_conversion_mm(vb, w_mm, h_mm)
-		
-	info("width : {:.1f}mm".format(w_mm))
-	info("height: {:.1f}mm".format(h_mm))
+	to_mm, mm_to = doc.to_mm, doc.mm_to
 	
 	#info("scale: 1mm is {:.3f}".format(1*mm_to))
 	#info("scale: 1 is {:.3f}mm".format(1*to_mm))
 	
 	tolerance = TOLERANCE_MM * mm_to
 	
-	profil = read_poly_from_svg_path(root, 'profil', tolerance)
+	profil = doc.get_poly('profil', tolerance, ADAPTIVE_FLATTERN)
 	if profil == None:		
 		fail("ERROR: brak profilu na rysunku")
 	
-	obrys = read_poly_from_svg_path(root, 'obrys', tolerance)
+	obrys = doc.get_poly('obrys', tolerance, ADAPTIVE_FLATTERN)
 	if obrys == None:
 		fail("ERROR: brak obrysu na rysunku")
 		
@@ -342,7 +704,7 @@ def main_segment(iname, start_label, end_label):
 	pos = 0.0
 	
 	
-	cross_poczatek = read_poly_from_svg_path(root, start_label, tolerance)
+	cross_poczatek = doc.get_poly(start_label, tolerance, ADAPTIVE_FLATTERN)
 	if cross_poczatek != None:
 		ths = intersect_poly_poly(obrys, cross_poczatek)
 		if len(ths) != 1:
@@ -360,7 +722,7 @@ def main_segment(iname, start_label, end_label):
 		end = pos
 		info("end: at the beggining")
 	else:
-		cross_koniec = read_poly_from_svg_path(root, end_label, tolerance)
+		cross_koniec = doc.get_poly(end_label, tolerance, ADAPTIVE_FLATTERN)
 		if cross_koniec != None:
 			
 			ths = intersect_poly_poly(obrys, cross_koniec)
@@ -387,78 +749,107 @@ def main_segment(iname, start_label, end_label):
 		profil.get_point(profil.get_length()),
 	)
 	
-
-	
+	with timing.stage('profile_table'):
+		table = ProfileTable(profil, odcinek)
 	
-	# setup view
-	if SHOW_GUI:
-		plt.ion()
-		plt.show()
-		#plt.axis([vb[0], vb[0]+vb[2], vb[1], vb[1]+vb[3]])
-				
-		profil.render(plt)
-		obrys.render(plt)
-		odcinek.render(plt)
-		if cross_poczatek:
-			cross_poczatek.render(plt)
-		if cross_koniec:
-			cross_koniec.render(plt)
-			
 
-	rs = []
-	rs_cover = []
 	
 	
 	info("output length: {:.1f}mm".format(delta*to_mm))
 	info("running now...")
 	
-	last_progress = 0
-	
 	step = STEP_MM * mm_to
-	total = 0.0
 	
-	while total < delta:
+	if opts['cprofile']:
+		import cProfile, pstats
+		prof = cProfile.Profile()
+		prof.enable()
+	
+	with timing.stage('stations'):
+		if opts['max_error'] is None:
+			totals, poss = get_stations(pos, end, delta, step, obrys.get_length())
+			values, covers = calc_values(poss, obrys, table)
+		else:
+			info("adaptive sampling: max error {}mm".format(opts['max_error']))
+			totals, poss, values, covers = sample_adaptive(
+				pos, delta, obrys, table, 
+				max_err = opts['max_error'] * mm_to, 
+				max_step = ADAPTIVE_MAX_STEP_MM * mm_to, 
+				min_step = ADAPTIVE_MIN_STEP_MM * mm_to,
+			)
+	
+	if opts['cprofile']:
+		prof.disable()
+		prof_name = get_output_name(name, start_label, end_label, 'cprofile')
+		prof.dump_stats(prof_name)
+		pstats.Stats(prof, stream=sys.stdout).sort_stats('cumulative').print_stats(15)
+		info("station loop profile written to {}".format(prof_name))
 	
-		# print("pos,end = {:.1f},{:.1f}".format(pos*to_mm,end*to_mm))
-		# print("total,delta = {:.1f},{:.1f}".format(total*to_mm,delta*to_mm))
-				
-		value, cover_p = calc_value(pos, obrys, profil, odcinek, to_mm)	
-		if PRINT_OUTPUT:	
-			print("OUTPUT: {:6.1f} {:6.1f} [mm] {:6.1f} {:6.1f} [u]".format(total*to_mm, value*to_mm, pos, value))
-		
-		progress = int((total/delta) * 100)
-		if progress % 20 == 0 and progress != last_progress:
-			info("{:5}% done...".format(progress))
-			last_progress = progress
-		
-		
-		rs.append( (total, value) )
-		rs_cover.append( cover_p )
-		
-		pos += step
-		
-		if pos > obrys.get_length():
-			pos -= obrys.get_length()
-		
-		total += step
-		
-		
-		
-	# value at the end
-	total = delta
-	pos = end
-	value, cover_p = calc_value(pos, obrys, profil, odcinek, to_mm)
 	if PRINT_OUTPUT:
-		print("OUTPUT: {:6.1f} {:6.1f} [mm] {:6.1f} {:6.1f} [u]".format(total*to_mm, value*to_mm, pos, value))
-		
-	rs.append((total, value))
-	rs_cover.append( cover_p )
+		for total, value, pos in zip(totals, values, poss):
+			print("OUTPUT: {:6.1f} {:6.1f} [mm] {:6.1f} {:6.1f} [u]".format(total*to_mm, value*to_mm, pos, value))
+	
+	rs = np.stack([totals, values], axis=1)
+	rs_cover = covers
 	
 	info("{} points generated".format(len(rs)))
+	
+	if opts['simplify'] is not None:
+		# drop stations the outputs can do without, within the given deviation
+		tol = opts['simplify'] * mm_to
+		rs = rs[simplify(rs, tol)]
+		rs_cover = rs_cover[simplify(rs_cover, tol)]
+		info("simplify: max deviation {}mm, side {} points ({:.1f}%), top {} points ({:.1f}%)".format(
+			opts['simplify'], len(rs), 100.0 * len(rs) / len(totals), len(rs_cover), 100.0 * len(rs_cover) / len(totals)))
 			
 		
-	save_side_svg(rs, "{}-{}-{}-side.svg".format(name,start_label,end_label), 10*mm_to, to_mm)
-	save_top_svg(rs_cover, "{}-{}-{}-top.svg".format(name,start_label,end_label), 10*mm_to, to_mm)
+	outputs = []
+	if 'svg' in opts['formats']:
+		side_name = get_output_name(name, start_label, end_label, 'side')
+		top_name = get_output_name(name, start_label, end_label, 'top')
+		save_side_svg(rs, side_name, 10*mm_to, to_mm)
+		save_top_svg(rs_cover, top_name, 10*mm_to, to_mm)
+		outputs += [side_name, top_name]
+	
+	if SHOW_GUI or opts['overlay'] is not None:
+		keep = decimate(len(poss), GUI_DECIMATE)
+		segs = np.stack([obrys.get_points(poss[keep]), profil.get_points(covers[keep,0])], axis=1)
+		shapes = [('obrys', obrys.xs), ('profil', profil.xs), ('odcinek', np.array([odcinek.p0, odcinek.p1]))]
+		for label in dict.fromkeys([start_label, end_label]):
+			cross = doc.get_poly(label, tolerance, ADAPTIVE_FLATTERN)
+			if cross is not None:
+				shapes.append((label, cross.xs))
+		
+		# stations are all computed by now, drawing never holds up the sampling
+		if SHOW_GUI:
+			get_gui().Viewer(shapes).play(segs, values[keep] * to_mm, GUI_FPS, GUI_BATCH)
+		
+		if opts['overlay'] is not None:
+			overlay_name = get_output_name(name, start_label, end_label, 'overlay-' + opts['overlay'])
+			if opts['overlay'] == 'svg':
+				save_overlay_svg(overlay_name, doc.vb, shapes, segs)
+			else:
+				get_gui().save_overlay_png(overlay_name, shapes, segs, GUI_DPI)
+				info("written to {}".format(overlay_name))
+			outputs.append(overlay_name)
+	
+	# raw stations, not simplified
+	fmts = [fmt for fmt in OUTPUT_FORMATS if fmt != 'svg' and fmt in opts['formats']]
+	if fmts:
+		stations = np.stack([totals, values, covers[:,0], covers[:,1], poss], axis=1) * to_mm
+		for fmt in fmts:
+			outputs.append(save_stations(get_output_name(name, start_label, end_label, 'stations-' + fmt), fmt, stations))
+	
+	if opts['profile']:
+		# first segment of a run also includes loading of the document
+		report_name = get_output_name(name, start_label, end_label, 'profile-' + opts['profile'])
+		timing.save_report(report_name, opts['profile'], {'start': start_label, 'end': end_label, 'points': len(totals)})
+		info("stage profile written to {}".format(report_name))
+		timing.reset()
+	
+	write_stamp(stamp_name, fingerprint, len(totals), outputs)
+	
+	return {'start': start_label, 'end': end_label, 'points': len(totals), 'outputs': outputs, 'skipped': False}
 
 	
 if __name__ == '__main__':
@@ -0,0 +1,95 @@
+from log import fail, info, warning
+
+"""
+Command line options of fpp; kept free of numpy and the geometry modules so
+that the usage path (and the client) start fast.
+"""
+
+VERSION = '0.4.0'
+
+OUTPUT_FORMATS = ('svg', 'npy', 'npz', 'csv')
+
+
+def formats(s):
+	""" Comma separated list of OUTPUT_FORMATS
+	
+	>>> formats('svg,npy')
+	['svg', 'npy']
+	"""
+	xs = s.split(',')
+	for x in xs:
+		if x not in OUTPUT_FORMATS:
+			raise ValueError(x)
+	return xs
+
+
+OVERLAY_FORMATS = ('svg', 'png')
+
+
+def overlay(s):
+	""" One of OVERLAY_FORMATS """
+	if s not in OVERLAY_FORMATS:
+		raise ValueError(s)
+	return s
+
+
+PROFILE_FORMATS = ('json', 'text')
+
+
+def profile(s):
+	""" One of PROFILE_FORMATS """
+	if s not in PROFILE_FORMATS:
+		raise ValueError(s)
+	return s
+
+
+# option -> (key, type, default); type None marks a flag
+OPTIONS = {
+	'--jobs': ('jobs', int, 1),
+	'--cache': ('cache', str, None),
+	'--cache-mb': ('cache_mb', float, 256),
+	'--max-error': ('max_error', float, None),
+	'--simplify': ('simplify', float, None),
+	'--formats': ('formats', formats, ['svg']),
+	'--overlay': ('overlay', overlay, None),
+	'--force': ('force', None, False),
+	'--profile': ('profile', profile, None),
+	'--cprofile': ('cprofile', None, False),
+}
+
+USAGE = "usage: fpp [--jobs N] [--cache DIR] [--cache-mb MB] [--max-error MM] [--simplify MM] [--formats svg,npy,npz,csv] [--overlay svg|png] [--force] [--profile json|text] [--cprofile] <input.svg> <label1> <label2> [label3] ..."
+
+
+def parse_args(argv, options=OPTIONS):
+	""" Split command line arguments into options and positional arguments
+	options -- option table, see OPTIONS
+	return -- opts (dict), args (list)
+	
+	>>> opts, args = parse_args(['a.svg', '--jobs', '4', 'A', 'B'])
+	>>> opts['jobs'], args
+	(4, ['a.svg', 'A', 'B'])
+	"""
+	opts = {key: default for key, _, default in options.values()}
+	args = []
+	i = 0
+	while i < len(argv):
+		x = argv[i]
+		if x in options:
+			key, conv, _ = options[x]
+			if conv is None:
+				opts[key] = True
+				i += 1
+			elif i + 1 < len(argv):
+				try:
+					opts[key] = conv(argv[i+1])
+				except ValueError:
+					fail("ERROR: invalid value for {}: {!r}".format(x, argv[i+1]))
+				i += 2
+			else:
+				fail("ERROR: option {} requires a value".format(x))
+		elif x.startswith('--'):
+			fail("ERROR: unknown option: {}".format(x))
+		else:
+			args.append(x)
+			i += 1
+	return opts, args
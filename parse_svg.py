@@ -1,7 +1,9 @@
 from reader import Reader
-from path import Bezier1, Bezier3, Vec, fail, Line
-import sys, math
+from path import Bezier1, Bezier3, BezierSet, Vec, fail, Line
+import sys, math, re
+import numpy
 from log import fail, info, warning
+import timing
 
 	
 	
@@ -33,8 +35,40 @@ def accept_point(r):
 	y = accept_number(r)
 	return Vec(x,y)
 
+# whole path data in the form accepted by accept_path
+PATH_RE = re.compile(r'[ \t\n]*(?:[mzlcMZCL][ \t\n]*|[-+0-9.]+(?![-+0-9.])[ \t\n]*,[ \t\n]*[-+0-9.]+(?![-+0-9.])[ \t\n]*)*\Z')
+TOKEN_RE = re.compile(r'([mzlcMZCL])|([-+0-9.]+)(?![-+0-9.])[ \t\n]*,[ \t\n]*([-+0-9.]+)')
+
+def tokenize_path(s):
+	""" Bulk version of accept_path: commands and points in one pass over 's
+	return -- list of commands and points (Vec), or None if 's is malformed
+	
+	>>> tokenize_path("M 1,2 l 3.5 , -4 z")
+	['M', array([ 1.,  2.]), 'l', array([ 3.5, -4. ]), 'z']
+	>>> tokenize_path("M 1,2.3.4") is None
+	True
+	"""
+	if PATH_RE.match(s) is None:
+		return None
+	
+	tokens = TOKEN_RE.findall(s)
+	try:
+		xs = [float(v) for c,x,y in tokens if not c for v in (x,y)]
+	except ValueError:
+		return None
+	
+	points = iter(numpy.array(xs).reshape(-1, 2))
+	return [c if c else next(points) for c,x,y in tokens]
+
+@timing.timed('accept_path')
 def accept_path(r):
 	
+	# fast path; malformed input goes through the reader below for error messages
+	elems = tokenize_path(r.src[r.i:])
+	if elems is not None:
+		r.i = len(r.src)
+		return elems
+	
 	elems = []
 	
 	accept_white(r)
@@ -98,9 +132,14 @@ def get_arity(c):
 		'C': 3,	
 	}[c]
 
-def make_path(prog):
+@timing.timed('make_path')
+def make_path(prog, as_set=False):
 	"""
+	as_set -- return BezierSet built directly from the control points instead of list
 	return -- list of beziers
+	
+	>>> make_path(accept_path(Reader("M 0,0 L 1,0 c 0,1 1,1 1,0 z")), as_set=True).kinds
+	array([1, 3, 1])
 	"""
 	parts = []
 	cmd = '?'	       # current command
@@ -136,8 +175,8 @@ def make_path(prog):
 			
 		elif cmd == 'z' or cmd == 'Z':
 			cp = args.pop()
-			np = parts[0].get_point(0.0)
-			parts.append(Bezier1(cp, np));
+			np = parts[0][0]
+			parts.append((cp, np))
 			cmd = '?'
 			args.append(np)
 			
@@ -145,14 +184,14 @@ def make_path(prog):
 			d = args.pop()
 			cp = args.pop()
 			np = cp + d
-			parts.append(Bezier1(cp, np));
+			parts.append((cp, np))
 			cmd = 'l'
 			args.append(np)
 
 		elif cmd == 'L':
 			np = args.pop()
 			cp = args.pop()
-			parts.append(Bezier1(cp, np));
+			parts.append((cp, np))
 			cmd = 'L'
 			args.append(np)
 			
@@ -166,7 +205,7 @@ def make_path(prog):
 			c0 = cp + dc0
 			np = cp + dnp
 						
-			parts.append(Bezier3(cp, c0, c1, np));
+			parts.append((cp, c0, c1, np))
 			cmd = 'c'
 			args.append(np)
 		
@@ -176,14 +215,16 @@ def make_path(prog):
 			c0 = args.pop()
 			cp = args.pop()
 						
-			parts.append(Bezier3(cp, c0, c1, np));
+			parts.append((cp, c0, c1, np))
 			cmd = 'C'
 			args.append(np)
 				
 		else:
 			fail("ERROR: unknown command: {}".format(cmd))
 	
-	return parts
+	if as_set:
+		return BezierSet.from_points(parts)
+	return [Bezier1(*p) if len(p) == 2 else Bezier3(*p) for p in parts]
 		
 	
 
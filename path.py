@@ -2,6 +2,7 @@ import numpy as np
 import math
 from reader import Reader
 from log import fail, info, warning
+import timing
 
 
 def Vec(*col):
@@ -81,27 +82,86 @@ def distance(a,b):
 def get_lengths(xs):
 	for i in range(len(xs) - 1):
 		yield distance(xs[i], xs[i+1])
+		
+		
+def get_cumulative(ls):
+	""" Distances from the first vertex to each vertex 
+	
+	>>> print(get_cumulative([1.0, 2.0]))
+	[ 0.  1.  3.]
+	"""
+	return np.concatenate([[0.0], np.cumsum(ls, dtype=float)])
 	
 	
 class Poly:
-	def __init__(self, xs):
-		self.xs = xs
-		self.ls = list(get_lengths(xs))
+	""" Polyline stored as one contiguous (N,2) float64 buffer
+	
+	xs -- vertices (N,2)
+	vs -- section vectors (N-1,2)
+	ls -- section lengths (N-1,)
+	us -- section unit directions (N-1,2), zero for zero-length sections
+	cs -- distance from the first vertex to each vertex (N,)
+	"""
+	def __init__(self, xs, ls=None):
+		self.reset(xs, ls)
+	
+	def reset(self, xs, ls=None):
+		""" Set vertices and recompute section arrays
+		xs -- vertices; float64 arrays are used without a copy (may be read-only)
+		ls -- precomputed section lengths or None
+		"""
+		self.xs = np.asarray(xs, dtype=float).reshape(-1, 2)
+		self.vs = np.diff(self.xs, axis=0)
+		if ls is None:
+			self.ls = np.hypot(self.vs[:,0], self.vs[:,1])
+		else:
+			self.ls = np.asarray(ls, dtype=float)
+		self.us = self.vs / np.where(self.ls == 0, 1.0, self.ls)[:,None]
+		self.cs = get_cumulative(self.ls)
+		self.index = None
+	
+	def get_index(self):
+		""" Spatial index over sections, built on first use """
+		if self.index is None:
+			self.index = GridIndex(self)
+		return self.index
 	
 	def get_length(self):
-		return sum(self.ls)
+		return self.cs[-1]
 		
 	def get_vertex(self, i):
 		return self.xs[i]
 	
+	def get_vertices(self):
+		""" Read-only view of the vertex buffer (no copy) 
+		
+		>>> p = Poly([Vec(0,0), Vec(1,0)])
+		>>> np.shares_memory(p.get_vertices(), p.xs)
+		True
+		"""
+		v = self.xs.view()
+		v.flags.writeable = False
+		return v
+	
 	def get_section_length(self, i):
 		"""
 		>>> p = Poly([Vec(0,0), Vec(-3,-4)])
 		>>> assert p.get_section_length(0) == 5
+		>>> print(p.us[0])
+		[-0.6 -0.8]
 		"""
 		return self.ls[i]
 		
+	def get_section_start(self, i):
+		""" Distance along the curve to the begining of section 'i """
+		return self.cs[i]
+		
 	def join(self, poly):
+		"""
+		>>> p = Poly([Vec(0,0),Vec(0,1)]).join(Poly([Vec(0,1),Vec(0,3)]))
+		>>> print(p.cs)
+		[ 0.  1.  3.]
+		"""
 		p = Poly([])
 		p.extend(self.xs)
 		p.extend(poly.xs)
@@ -112,14 +172,21 @@ class Poly:
 		>>> p = Poly([Vec(0,0),Vec(0,1)])
 		>>> p.extend([Vec(0,1),Vec(0,3)])
 		>>> print(p.xs)
-		[array([0, 0]), array([0, 1]), array([0, 3])]
+		[[ 0.  0.]
+		 [ 0.  1.]
+		 [ 0.  3.]]
 		>>> print(p.ls)
-		[1.0, 2.0]
+		[ 1.  2.]
+		>>> print(p.get_length())
+		3.0
 		"""
+		xs = np.asarray(xs, dtype=float).reshape(-1, 2)
 		if len(xs) > 0:
-			assert (self.xs[-1] == xs[0]).all()
-			self.xs.extend(xs[1:])
-			self.ls.extend(get_lengths(xs))
+			if len(self.xs) == 0:
+				self.reset(xs)
+			else:
+				assert (self.xs[-1] == xs[0]).all()
+				self.reset(np.concatenate([self.xs, xs[1:]]))
 	
 	def size(self):
 		""" Number of sections """
@@ -132,7 +199,25 @@ class Poly:
 		if self.is_empty():
 			return True
 		else:
-			return self.xs[0] == self.xs[-1]
+			return bool((self.xs[0] == self.xs[-1]).all())
+	
+	def find_section(self, d):
+		""" Index of the section containing point at distance 'd (binary search)
+		return -- index or None if 'd is beyond the end of the poly
+		
+		>>> p = Poly([Vec(0,0), Vec(1,0), Vec(1,1), Vec(0,1)])
+		>>> p.find_section(0.0), p.find_section(1.0), p.find_section(1.5), p.find_section(3.5)
+		(0, 0, 1, None)
+		"""
+		i = int(np.searchsorted(self.cs, d, side='left')) - 1
+		if i < 0:
+			return 0
+		elif i < self.size():
+			return i
+		elif math.isclose(d, self.cs[-1]):
+			return self.size() - 1
+		else:
+			return None
 	
 	def get_point(self, d):
 		""" Return 'point laying on the curve at a distance 'd measured along the curve
@@ -148,6 +233,8 @@ class Poly:
 		[ 0.  1.]
 		>>> print(p.get_point(3.0))
 		[ 0.  1.]
+		>>> print(p.get_point(1.5))
+		[ 1.   0.5]
 		"""
 		
 		if self.is_empty():
@@ -156,36 +243,232 @@ class Poly:
 		#while d < 0:
 		#	d += self.get_length()
 		
+		i = self.find_section(d)
+		if i is None:
+			return None
 		
-		for i in range(0, self.size()):
-			# current section xs[i],xs[i+1]
-			# current section length ls[i]
-			
-			sect_len = self.ls[i]
-			x0 = self.xs[i]
-			x1 = self.xs[i+1]
-			
-			if d < sect_len or math.isclose(d, sect_len):
-				return get_point_line(x0, x1, d/sect_len)
-				
-			else:			
-				d -= sect_len
+		sect_len = self.ls[i]
+		if sect_len == 0:
+			return self.xs[i].copy()
 		
-		return None
-			
+		return get_point_line(self.xs[i], self.xs[i+1], (d - self.cs[i])/sect_len)
+	
+	def get_points(self, ds, wrap=False):
+		""" Vectorized get_point
+		ds -- array of distances measured along the curve; clamped to [0, length]
+		wrap -- take distances modulo length (closed outlines)
+		return -- (N,2) array
+		
+		>>> p = Poly([Vec(0,0), Vec(1,0), Vec(1,1), Vec(0,1)])
+		>>> print(p.get_points([0.0, 1.5, 3.0]))
+		[[ 0.   0. ]
+		 [ 1.   0.5]
+		 [ 0.   1. ]]
+		>>> print(p.get_points([4.5, -0.5], wrap=True))
+		[[ 1.   0.5]
+		 [ 0.5  1. ]]
+		"""
+		if self.is_empty():
+			return None
+		
+		ds = np.asarray(ds, dtype=float)
+		if wrap:
+			ds = np.mod(ds, self.get_length())
+		
+		i = np.clip(np.searchsorted(self.cs, ds, side='left') - 1, 0, self.size() - 1)
+		sect_len = self.ls[i]
+		t = np.clip((ds - self.cs[i]) / np.where(sect_len == 0, 1.0, sect_len), 0.0, 1.0)
+		
+		return self.xs[i] + t[:,None] * self.vs[i]
 			
 	def render(self, plt):
-		ps = []
-		for x in self.xs:
-			ps.append(x)
-			
-		ps = np.array(ps).transpose()
-		return plt.plot(ps[0], ps[1])	
+		return plt.plot(self.xs[:,0], self.xs[:,1])
 			
 				
 				
 
 
+def concat_ranges(starts, lens):
+	""" Concatenation of ranges [start, start+len)
+	
+	>>> print(concat_ranges(np.array([3,10]), np.array([2,3])))
+	[ 3  4 10 11 12]
+	"""
+	total = int(lens.sum())
+	offs = np.repeat(starts - np.cumsum(lens) + lens, lens)
+	return offs + np.arange(total)
+
+
+@timing.timed('simplify')
+def simplify(xs, tolerance):
+	""" Douglas-Peucker simplification of polyline 'xs, all ranges split at once
+	tolerance -- max distance of a dropped vertex from the kept section replacing it
+	return -- indices of kept vertices (first and last always kept)
+
+	>>> print(simplify(np.array([[0,0],[1,0.05],[2,0],[3,1],[4,0]]), 0.1))
+	[0 2 3 4]
+	"""
+	xs = np.asarray(xs, dtype=float).reshape(-1, 2)
+	n = len(xs)
+	if n <= 2:
+		return np.arange(n)
+
+	keep = np.zeros(n, dtype=bool)
+	keep[[0, -1]] = True
+	while True:
+		idx = np.flatnonzero(keep)
+		k = np.minimum(np.searchsorted(idx, np.arange(n), side='right') - 1, len(idx) - 2)
+		a = xs[idx[k]]
+		v = xs[idx[k+1]] - a
+		w = xs - a
+		vv = (v * v).sum(axis=1)
+		t = np.clip((w * v).sum(axis=1) / np.where(vv == 0, 1.0, vv), 0.0, 1.0)
+		d = np.hypot(*(w - t[:,None] * v).T)
+		d[keep] = 0.0
+
+		# farthest vertex of each range, split where beyond tolerance
+		dmax = np.maximum.reduceat(d, idx[:-1])
+		far = (d == dmax[k]) & (d > tolerance)
+		if not far.any():
+			return idx
+		_, first = np.unique(k[far], return_index=True)
+		keep[np.flatnonzero(far)[first]] = True
+
+
+class GridIndex:
+	""" Uniform grid over sections of a Poly
+	
+	Each cell lists sections whose (slightly padded) bounding box overlaps it.
+	Cells are about twice the median section length (grown while sections 
+	would fill more than 8 cells each on average); only occupied cells are 
+	stored. Queries return candidate section indices (sorted, unique); 
+	candidates still need an exact intersection test.
+	
+	>>> p = Poly([Vec(i, i % 2) for i in range(101)])
+	>>> g = GridIndex(p)
+	>>> r = g.query_box(Vec(50.2,0), Vec(50.4,1))
+	>>> 50 in r and len(r) < 20
+	True
+	>>> r = g.query_line(Vec(30.5,0), Vec(30.5,1))
+	>>> 30 in r and len(r) < 20
+	True
+	>>> print(g.query_line(Vec(-1,20), Vec(1,20)))
+	[]
+	"""
+	def __init__(self, poly):
+		n = poly.size()
+		lo = np.minimum(poly.xs[:-1], poly.xs[1:])
+		hi = np.maximum(poly.xs[:-1], poly.xs[1:])
+		
+		if n > 0:
+			self.x0 = lo.min(axis=0)
+			ext = hi.max(axis=0) - self.x0
+		else:
+			self.x0 = Vec(0.0, 0.0)
+			ext = Vec(0.0, 0.0)
+		
+		self.eps = 1e-9 * max(ext.max(), 1.0)
+		
+		cell = 2 * np.median(poly.ls) if n > 0 else 0.0
+		cell = max(cell, ext.max() / max(n, 1), self.eps)
+		while 1:
+			self.cell = cell
+			self.shape = (ext // self.cell).astype(np.int64) + 1
+			c0 = self.get_cells(lo - self.eps)
+			c1 = self.get_cells(hi + self.eps)
+			ws = c1 - c0 + 1
+			counts = ws[:,0] * ws[:,1]
+			if counts.sum() <= 8 * n:
+				break
+			cell *= 2
+		
+		firsts = np.cumsum(counts) - counts
+		local = np.arange(int(counts.sum())) - np.repeat(firsts, counts)
+		wx = np.repeat(ws[:,0], counts)
+		ix = np.repeat(c0[:,0], counts) + local % wx
+		iy = np.repeat(c0[:,1], counts) + local // wx
+		ids = iy * self.shape[0] + ix
+		
+		order = np.argsort(ids, kind='stable')
+		ids = ids[order]
+		self.sections = np.repeat(np.arange(n), counts)[order]
+		self.cells, self.starts = np.unique(ids, return_index=True)
+		self.starts = np.append(self.starts, len(ids))
+	
+	def get_cells(self, ps):
+		""" Cell coordinates (clipped to grid) of points 'ps """
+		return np.clip(((ps - self.x0) // self.cell).astype(np.int64), 0, self.shape - 1)
+	
+	def query_cells(self, ix, iy):
+		""" Sections listed in cells (ix[k], iy[k]) """
+		ids = iy * self.shape[0] + ix
+		k = np.searchsorted(self.cells, ids)
+		k = k[(k < len(self.cells)) & (self.cells[np.minimum(k, len(self.cells) - 1)] == ids)]
+		starts = self.starts[k]
+		return np.unique(self.sections[concat_ranges(starts, self.starts[k + 1] - starts)])
+	
+	def query_box(self, lo, hi):
+		""" Sections which may overlap box [lo, hi] """
+		c0 = self.get_cells(lo - self.eps)
+		c1 = self.get_cells(hi + self.eps)
+		ix, iy = np.meshgrid(np.arange(c0[0], c1[0] + 1), np.arange(c0[1], c1[1] + 1))
+		return self.query_cells(ix.ravel(), iy.ravel())
+	
+	def query_segment(self, p0, p1):
+		""" Sections which may intersect section p0,p1 """
+		return self.query_box(np.minimum(p0, p1), np.maximum(p0, p1))
+	
+	def query_line(self, p0, p1):
+		""" Sections which may intersect infinite line through p0,p1 """
+		d = p1 - p0
+		if not d.any():
+			return np.array([], dtype=int)
+		
+		lo = self.x0 - self.eps
+		hi = self.x0 + self.shape * self.cell + self.eps
+		
+		# clip line to the grid box
+		u0, u1 = -np.inf, np.inf
+		for k in range(2):
+			if d[k] == 0:
+				if not (lo[k] <= p0[k] <= hi[k]):
+					return np.array([], dtype=int)
+			else:
+				a = (lo[k] - p0[k]) / d[k]
+				b = (hi[k] - p0[k]) / d[k]
+				u0 = max(u0, min(a,b))
+				u1 = min(u1, max(a,b))
+		
+		if u0 > u1:
+			return np.array([], dtype=int)
+		
+		q0 = p0 + u0 * d
+		q1 = p0 + u1 * d
+		
+		# walk columns crossed by the clipped line, take y range within each column
+		c0 = self.get_cells(np.minimum(q0, q1))
+		c1 = self.get_cells(np.maximum(q0, q1))
+		cols = np.arange(c0[0], c1[0] + 1)
+		
+		if d[0] == 0:
+			ya = np.full(len(cols), min(q0[1], q1[1]))
+			yb = np.full(len(cols), max(q0[1], q1[1]))
+		else:
+			xa = np.maximum(self.x0[0] + cols * self.cell, min(q0[0], q1[0]))
+			xb = np.minimum(self.x0[0] + (cols + 1) * self.cell, max(q0[0], q1[0]))
+			ya = p0[1] + (xa - p0[0]) / d[0] * d[1]
+			yb = p0[1] + (xb - p0[0]) / d[0] * d[1]
+			ya, yb = np.minimum(ya, yb), np.maximum(ya, yb)
+		
+		iy0 = self.get_cells(np.stack([xa if d[0] != 0 else ya, ya - self.eps], axis=1))[:,1]
+		iy1 = self.get_cells(np.stack([xa if d[0] != 0 else yb, yb + self.eps], axis=1))[:,1]
+		lens = iy1 - iy0 + 1
+		
+		ix = np.repeat(cols, lens)
+		iy = concat_ranges(iy0, lens)
+		return self.query_cells(ix, iy)
+
+
 def get_point_line(x0, x1, t):
 	""" Point at t
 	
@@ -245,6 +528,8 @@ class Bezier3:
 		""" Defined by control points """		
 		self.mt = Mat(None, [p0, 3 * p1, 3 * p2, p3])
 		self._p0 = p0
+		self._p1 = p1
+		self._p2 = p2
 		self._p3 = p3
 				
 	def get_point(self, t):
@@ -253,95 +538,340 @@ class Bezier3:
 		v = Vec(h*h*h, h*h*t, h*t*t, t*t*t)		
 		p = self.mt.dot(v)
 		return p
+	
+	def get_points(self, ts):
+		""" Points at each of 'ts (array) 
+		return -- (N,2) array
+		
+		>>> b = Bezier3(Vec(0,0), Vec(0,1), Vec(1,1), Vec(1,0))
+		>>> print(b.get_points(np.array([0.0, 0.5, 1.0])))
+		[[ 0.    0.  ]
+		 [ 0.5   0.75]
+		 [ 1.    0.  ]]
+		"""
+		h = 1.0 - ts
+		return self.mt.dot(np.stack([h*h*h, h*h*ts, h*ts*ts, ts*ts*ts])).T
+	
+	def get_max_d2(self):
+		""" Upper bound of |B''(t)| on [0,1] """
+		a = self._p0 - 2 * self._p1 + self._p2
+		b = self._p1 - 2 * self._p2 + self._p3
+		return 6 * max(math.sqrt(a.dot(a)), math.sqrt(b.dot(b)))
 		
 	def __str__(self):
 		return "Bezier3({},-,-,{})".format(self._p0, self._p3)
 	
 
 
-def flattern_bezier_list(parts, tolerance, name):
-	""" Return error and list of vertices
+def flattern_bezier_list(parts, tolerance, name, adaptive=False):
+	""" Return error and list of vertices (see BezierSet.flattern for an array)
+	parts -- list of Bezier1/Bezier3 or BezierSet
 	name -- name of the path (for error msgs)
+	adaptive -- see flattern_bezier3
 	"""
+	if type(parts) != BezierSet:
+		parts = BezierSet.from_parts(parts)
 	
-	max_err = 0.0
-	points = []		
-	for i,part in enumerate(parts):
-		if type(part) == Bezier3:
-			err, ps = flattern_bezier3(part, tolerance)
-			max_err = max(max_err, err)
-			
-		elif type(part) == Bezier1:
-			ps = [part.p0, part.p1]
-		
-		else:
-			fail("ERROR: unknown part type")
-			
-		
-		if points:
-			if not (points[-1] == ps[0]).all():
-				fail("ERROR: in path '{}': last point of segment {} is diffrent from first point of segment {}".format(name, i, i+1))
-			points.extend(ps[1:])
-		else:
-			assert len(ps[0]) == 2
-			points.extend(ps)
-		
-							
-	return max_err, points
+	err, xs = parts.flattern(tolerance, name, adaptive)
+	return err, list(xs)
+
+# max number of sections per curve
+FLATTERN_MAX_N = 16000
+
+def flattern_bezier3_ts(b3, ts):
+	""" Return errors of each section and array of vertices
+	ts -- increasing curve parameters of the vertices, from 0 to 1
+	
+	Error of a section is measured at 0.33, 0.50 and 0.67 of its length.
+	"""
+	xs = b3.get_points(ts)
+	x0 = xs[:-1]
+	x1 = xs[1:]
+	t0 = ts[:-1]
+	t1 = ts[1:]
+	
+	errs = np.zeros(len(t0))
+	for a in (0.33, 0.50, 0.67):
+		dv = get_point_line(x0, x1, a) - b3.get_points((1.0 - a) * t0 + a * t1)
+		errs = np.maximum(errs, np.hypot(dv[:,0], dv[:,1]))
+	
+	return errs, xs
 
 def flattern_bezier3_n(b3, n):
 	""" Return error and list of vertices 
 	n -- number of sections to aproximate with
 	"""
-	points = []
-	
-	max_err = 0.0
-	t0 = float(0)/n 
-	x0 = b3.get_point(t0)
-	
-	points.append(x0)
-	for i in range(0,n):
-		t1 = float(i+1)/n
-		x1 = b3.get_point(t1)			
-		
-		# B3 range [t0,t1] corresponding to [x0,x1] points
-				
-		# test points			
-		e = distance(get_point_line(x0, x1, 0.33), b3.get_point(0.67 * t0 + 0.33 * t1))
-		if e > max_err:
-			max_err = e
-		
-		e = distance(get_point_line(x0, x1, 0.50), b3.get_point(0.50 * t0 + 0.50 * t1))
-		if e > max_err:
-			max_err = e		
-			
-		e = distance(get_point_line(x0, x1, 0.67), b3.get_point(0.33 * t0 + 0.67 * t1))
-		if e > max_err:
-			max_err = e
-		
-		t0 = t1
-		x0 = x1
-		points.append(x0)
-		
-	return max_err, points
+	errs, xs = flattern_bezier3_ts(b3, np.arange(n + 1) / n)
+	return errs.max(), list(xs)
+
+def flattern_bezier3_adaptive(b3, tolerance):
+	""" Return error and list of vertices; neighbouring sections of the uniform 
+	division are joined where the curve is flat, see BezierSet.flattern_adaptive
+	
+	>>> b = Bezier3(Vec(0,0), Vec(100,0), Vec(100,0), Vec(100,10))
+	>>> err, ps = flattern_bezier3_adaptive(b, 0.1)
+	>>> err <= 0.1 and len(ps) < len(flattern_bezier3(b, 0.1)[1])
+	True
+	>>> arc = Bezier3(Vec(100,0), Vec(100,55.23), Vec(55.23,100), Vec(0,100))
+	>>> err, ps = flattern_bezier3_adaptive(arc, 0.1)
+	>>> err <= 0.1, len(ps) <= len(flattern_bezier3(arc, 0.1)[1])
+	(True, True)
+	"""
+	err, xs = BezierSet.from_parts([b3]).flattern(tolerance, 'bezier', adaptive=True)
+	return err, list(xs)
 
-def flattern_bezier3(b3, tolerance):
+def flattern_bezier3(b3, tolerance, adaptive=False):
 	""" Return error and list of vertices 
 	tolerance -- max allowed error
+	adaptive -- use non-uniform sections (see flattern_bezier3_adaptive)
+	
+	Uniform mode: the smallest number of sections with error within 'tolerance,
+	searched in [1, n] where n comes from the bound err <= max|B''| / (8 n^2).
+	
+	>>> b = Bezier3(Vec(120,160), Vec(35,200), Vec(220,260), Vec(220,40))
+	>>> err, ps = flattern_bezier3(b, 0.1)
+	>>> err <= 0.1, len(ps) - 1, flattern_bezier3_n(b, len(ps) - 2)[0] > 0.1
+	(True, 50, True)
 	"""
-	for n in range(1,16000):
-		err, points = flattern_bezier3_n(b3, n)
-		if err <= tolerance:
-			#info("aproximating curve with {} sections".format(n))
-			return err, points
-			
-	fail("ERROR: cannot approximate curve; err={}; tol={}".format(err, tolerance))
+	if adaptive:
+		return flattern_bezier3_adaptive(b3, tolerance)
+	
+	hi = max(1, int(math.ceil(math.sqrt(b3.get_max_d2() / (8 * tolerance)))))
+	hi = min(hi, FLATTERN_MAX_N)
+	
+	err, points = flattern_bezier3_n(b3, hi)
+	while err > tolerance:
+		if hi >= FLATTERN_MAX_N:
+			fail("ERROR: cannot approximate curve; err={}; tol={}".format(err, tolerance))
+		hi = min(2 * hi, FLATTERN_MAX_N)
+		err, points = flattern_bezier3_n(b3, hi)
+	
+	lo = 1
+	while lo < hi:
+		n = (lo + hi) // 2
+		if flattern_bezier3_n(b3, n)[0] <= tolerance:
+			hi = n
+		else:
+			lo = n + 1
+	
+	return flattern_bezier3_n(b3, hi)
 
 	
 	
 
 
 
+class BezierSet:
+	""" All parts of a path as stacked control point arrays
+	
+	kinds -- (K,) 1 for Bezier1, 3 for Bezier3
+	mts -- (K,2,4) same as Bezier3.mt: columns p0, 3*p1, 3*p2, p3
+	
+	Bezier1 parts are stored as cubics with control points at 1/3 and 2/3.
+	Points of many curves are evaluated with one Bernstein product.
+	
+	>>> s = BezierSet.from_parts([Bezier1(Vec(0,0), Vec(1,0)), Bezier3(Vec(1,0), Vec(1,1), Vec(2,1), Vec(2,0))])
+	>>> print(s.get_points(np.array([0, 1, 1]), np.array([0.5, 0.0, 0.5])))
+	[[ 0.5   0.  ]
+	 [ 1.    0.  ]
+	 [ 1.5   0.75]]
+	>>> err, xs = s.flattern(0.1, 'test')
+	>>> b = flattern_bezier3(Bezier3(Vec(1,0), Vec(1,1), Vec(2,1), Vec(2,0)), 0.1)
+	>>> len(xs) == len(b[1]) + 1 and err == b[0]
+	True
+	"""
+	def __init__(self, kinds, mts):
+		self.kinds = np.asarray(kinds, dtype=int)
+		self.mts = np.asarray(mts, dtype=float).reshape(-1, 2, 4)
+	
+	@staticmethod
+	def from_parts(parts):
+		kinds = []
+		mts = []
+		for part in parts:
+			if type(part) == Bezier3:
+				kinds.append(3)
+				mts.append(part.mt)
+			elif type(part) == Bezier1:
+				kinds.append(1)
+				mts.append(Mat(None, [part.p0, 2 * part.p0 + part.p1, part.p0 + 2 * part.p1, part.p1]))
+			else:
+				fail("ERROR: unknown part type")
+		return BezierSet(kinds, mts)
+	
+	@staticmethod
+	def from_points(parts):
+		""" parts -- list of control points (p0,p1) or (p0,p1,p2,p3) """
+		kinds = np.array([1 if len(p) == 2 else 3 for p in parts], dtype=int)
+		mts = np.zeros((len(parts), 2, 4))
+		
+		lines = kinds == 1
+		if lines.any():
+			p0, p1 = np.array([p for p in parts if len(p) == 2], dtype=float).transpose(1,0,2)
+			mts[lines] = np.stack([p0, 2 * p0 + p1, p0 + 2 * p1, p1], axis=2)
+		
+		curves = ~lines
+		if curves.any():
+			p0, p1, p2, p3 = np.array([p for p in parts if len(p) == 4], dtype=float).transpose(1,0,2)
+			mts[curves] = np.stack([p0, 3 * p1, 3 * p2, p3], axis=2)
+		
+		return BezierSet(kinds, mts)
+	
+	def size(self):
+		""" Number of parts """
+		return len(self.kinds)
+	
+	def get_points(self, idx, ts):
+		""" Points of parts 'idx at 'ts (arrays of the same length)
+		return -- (N,2) array
+		"""
+		h = 1.0 - ts
+		vs = np.stack([h*h*h, h*h*ts, h*ts*ts, ts*ts*ts], axis=1)
+		return np.einsum('nij,nj->ni', self.mts[idx], vs)
+	
+	def get_max_d2(self):
+		""" Upper bound of |B''(t)| on [0,1] of each part """
+		p0 = self.mts[:,:,0]
+		p1 = self.mts[:,:,1] / 3
+		p2 = self.mts[:,:,2] / 3
+		p3 = self.mts[:,:,3]
+		a = p0 - 2 * p1 + p2
+		b = p1 - 2 * p2 + p3
+		return 6 * np.maximum(np.hypot(a[:,0], a[:,1]), np.hypot(b[:,0], b[:,1]))
+	
+	def get_section_errors(self, idx, t0, t1):
+		""" Errors of sections [t0,t1] of parts 'idx, measured as in flattern_bezier3_ts """
+		x0 = self.get_points(idx, t0)
+		x1 = self.get_points(idx, t1)
+		errs = np.zeros(len(idx))
+		for a in (0.33, 0.50, 0.67):
+			dv = get_point_line(x0, x1, a) - self.get_points(idx, (1.0 - a) * t0 + a * t1)
+			errs = np.maximum(errs, np.hypot(dv[:,0], dv[:,1]))
+		return errs
+	
+	def get_uniform(self, ns):
+		""" Sections of uniform division of each part into 'ns sections
+		return -- idx, t0, t1 (flat arrays, ordered by part and t)
+		"""
+		idx = np.repeat(np.arange(self.size()), ns)
+		j = np.arange(len(idx)) - np.repeat(np.cumsum(ns) - ns, ns)
+		n = ns[idx]
+		return idx, j / n, (j + 1) / n
+	
+	def get_errors(self, ns):
+		""" Error of each part divided uniformly into 'ns sections """
+		idx, t0, t1 = self.get_uniform(ns)
+		errs = self.get_section_errors(idx, t0, t1)
+		return np.maximum.reduceat(errs, np.cumsum(ns) - ns)
+	
+	@timing.timed('flattern')
+	def flattern(self, tolerance, name, adaptive=False):
+		""" Return error and (N,2) array of vertices
+		name -- name of the path (for error msgs)
+		adaptive -- see flattern_bezier3
+		"""
+		if self.size() == 0:
+			return 0.0, np.zeros((0,2))
+		
+		ends = self.mts[:-1,:,3]
+		starts = self.mts[1:,:,0]
+		broken = np.flatnonzero((ends != starts).any(axis=1))
+		if len(broken):
+			i = broken[0] + 1
+			fail("ERROR: in path '{}': last point of segment {} is diffrent from first point of segment {}".format(name, i, i+1))
+		
+		if adaptive:
+			idx, t0, t1 = self.flattern_adaptive(tolerance)
+		else:
+			idx, t0, t1 = self.get_uniform(self.flattern_ns(tolerance))
+		
+		errs = self.get_section_errors(idx, t0, t1)
+		errs = errs[self.kinds[idx] == 3]
+		err = errs.max() if len(errs) else 0.0
+		
+		xs = self.get_points(np.append(idx, idx[-1]), np.append(t0, 1.0))
+		return err, xs
+	
+	def flattern_ns(self, tolerance):
+		""" Smallest uniform section count of each part, see flattern_bezier3 """
+		linear = self.kinds == 1
+		hi = np.ceil(np.sqrt(self.get_max_d2() / (8 * tolerance))).astype(int)
+		hi = np.where(linear, 1, np.clip(hi, 1, FLATTERN_MAX_N))
+		
+		errs = self.get_errors(hi)
+		while 1:
+			bad = (errs > tolerance) & ~linear
+			if not bad.any():
+				break
+			if (hi[bad] >= FLATTERN_MAX_N).any():
+				fail("ERROR: cannot approximate curve; err={}; tol={}".format(errs[bad].max(), tolerance))
+			hi = np.where(bad, np.minimum(2 * hi, FLATTERN_MAX_N), hi)
+			errs = self.get_errors(hi)
+		
+		lo = np.ones_like(hi)
+		while (lo < hi).any():
+			open_ = lo < hi
+			n = np.where(open_, (lo + hi) // 2, hi)
+			ok = (self.get_errors(n) <= tolerance) | linear
+			hi = np.where(open_ & ok, n, hi)
+			lo = np.where(open_ & ~ok, n + 1, lo)
+		
+		return hi
+	
+	def flattern_adaptive(self, tolerance):
+		""" Uniform sections (see flattern_ns) with neighbours joined while the joined section 
+		stays within 'tolerance, so a part never gets more sections than in uniform mode
+		return -- idx, t0, t1 (flat arrays, ordered by part and t)
+		"""
+		idx, t0, t1 = self.get_uniform(self.flattern_ns(tolerance))
+		idle = 0
+		offset = 0
+		while idle < 2:
+			# disjoint pairs (i, i+1) of the same part, starting at 'offset
+			i = np.arange(offset, len(idx) - 1, 2)
+			i = i[idx[i] == idx[i+1]]
+			ok = self.get_section_errors(idx[i], t0[i], t1[i+1]) <= tolerance
+			i = i[ok]
+			if len(i):
+				t1[i] = t1[i+1]
+				keep = np.ones(len(idx), dtype=bool)
+				keep[i+1] = False
+				idx = idx[keep]
+				t0 = t0[keep]
+				t1 = t1[keep]
+				idle = 0
+			else:
+				idle += 1
+			offset = 1 - offset
+		return idx, t0, t1
+
+
+
+def intersect_lines(x1, dx, y1, dy):
+	""" Batched intersection of lines x1 + t*dx and y1 + h*dy 
+	
+	Arguments are arrays of points/directions (...,2) broadcast against each 
+	other, e.g. sections (1,M,2) against lines of stations (N,1,2).
+	return -- ts, hs, valid (False for parallel lines, ts and hs are 0 there)
+	
+	>>> ts, hs, valid = intersect_lines(np.array([[0,0],[0,2]]), np.array([[4,4],[1,-1]]), Vec(2,0), Vec(-2,2))
+	>>> print(ts, hs, valid)
+	[ 0.25  0.  ] [ 0.5  0. ] [ True False]
+	"""
+	x1 = np.asarray(x1, dtype=float)
+	dx = np.asarray(dx, dtype=float)
+	b = np.asarray(y1, dtype=float) - x1
+	dy = np.asarray(dy, dtype=float)
+	
+	d = dx[...,0] * dy[...,1] - dx[...,1] * dy[...,0]
+	valid = d != 0
+	d = np.where(valid, d, 1.0)
+	
+	ts = np.round((b[...,0] * dy[...,1] - b[...,1] * dy[...,0]) / d, 12)
+	hs = np.round((b[...,0] * dx[...,1] - b[...,1] * dx[...,0]) / d, 12)
+	return np.where(valid, ts, 0.0), np.where(valid, hs, 0.0), valid
+
+
 def intersect_line_line(x1,x2, y1,y2):
 	"""
 	x1,x2 -- two points defining first line
@@ -353,24 +883,30 @@ def intersect_line_line(x1,x2, y1,y2):
 	>>> intersect_line_line(Vec(0,0), Vec(2,0), Vec(0,2), Vec(2,2))
 	[]
 	"""
-	
-	A = Mat(cols=[x2 - x1, -y2 + y1], rows=None)	
-	B = -x1 + y1
-	
-	d = det(A)
-	if d == 0:
+	t, h, valid = intersect_lines(x1, x2 - x1, y1, y2 - y1)
+	if not valid:
 		return []
-		
-	t,h = (adj(A).dot(B))/d
 	
-	return [(round(t,12),round(h,12))]
+	return [(float(t), float(h))]
+
+
+def dedup(rs):
+	""" Drop results equal to the previous one (the same point reported by two neighbouring sections)
 	
+	>>> dedup([(1.0, 2.0), (1.0, 2.0), (3.0, 0.0)])
+	[(1.0, 2.0), (3.0, 0.0)]
+	"""
+	return [r for k, r in enumerate(rs) if k == 0 or r != rs[k-1]]
 	
 	
+@timing.timed('intersect_poly_poly')
 def intersect_poly_poly(a,b):	
 	"""
 	return -- list of (t_len, h_len)
 	
+	Candidate section pairs come from the spatial index of the larger poly
+	and are intersected in one batch.
+	
 	>>> a = Poly([Vec(2,0), Vec(0,0), Vec(0,2)])
 	>>> b = Poly([Vec(-1,-1), Vec(1,1)])
 	>>> r = intersect_poly_poly(a,b)
@@ -378,37 +914,24 @@ def intersect_poly_poly(a,b):
 	"""
 	assert type(a) == Poly and type(b) == Poly
 	
-	rs = []	
-	
-	xp = 0.0
+	if a.size() >= b.size():
+		index = a.get_index()
+		pairs = [(i,j) for j in range(b.size()) for i in index.query_segment(b.xs[j], b.xs[j+1])]
+	else:
+		index = b.get_index()
+		pairs = [(i,j) for i in range(a.size()) for j in index.query_segment(a.xs[i], a.xs[i+1])]
 	
-	for i in range(a.size()):
+	if not pairs:
+		return []
 	
-		x1 = a.get_vertex(i)
-		x2 = a.get_vertex(i+1)
-		xl = a.get_section_length(i)
+	pairs.sort()
+	i, j = np.array(pairs).T
 	
-		yp = 0.0
-		for j in range(b.size()):
-			
-			y1 = b.get_vertex(j)
-			y2 = b.get_vertex(j+1)
-			yl = b.get_section_length(j)
-			
-			ths = intersect_line_line(x1,x2, y1,y2)
-			if ths:
-				t,h = ths[0]
-				if 0 <= t <= 1 and 0 <= h <= 1:
-					r = (xp + t*xl, yp + h*yl)
-					
-					if len(rs) == 0 or (rs and rs[-1] != r):
-						rs.append(r)
-			
-			yp += yl
-			
-		xp += xl
+	ts, hs, valid = intersect_lines(a.xs[i], a.vs[i], b.xs[j], b.vs[j])
+	hit = valid & (0 <= ts) & (ts <= 1) & (0 <= hs) & (hs <= 1)
 	
-	return rs
+	rs = zip((a.cs[i] + ts * a.ls[i])[hit].tolist(), (b.cs[j] + hs * b.ls[j])[hit].tolist())
+	return dedup(list(rs))
 	
 			
 	
@@ -418,6 +941,8 @@ def intersect_poly_line(poly, line):
 	"""
 	return list of (t_len, h_01)
 	
+	Only sections listed by the spatial index along the line are tested.
+	
 	>>> p = Poly([Vec(0,2), (100,2)])
 	>>> l = Line(Vec(50,0), Vec(50, -1))
 	>>> print(intersect_poly_line(p, l))
@@ -429,33 +954,18 @@ def intersect_poly_line(poly, line):
 	y1 = line.p0
 	y2 = line.p1
 	
-	rs = []	
+	i = np.asarray(poly.get_index().query_line(y1, y2), dtype=int)
 	
-	xp = 0.0
-	for i in range(poly.size()):
+	ts, hs, valid = intersect_lines(poly.xs[i], poly.vs[i], y1, y2 - y1)
+	hit = valid & (0.0 <= ts) & (ts <= 1.0)
 	
-		x1 = poly.get_vertex(i)
-		x2 = poly.get_vertex(i+1)
-		xl = poly.get_section_length(i)
-	
-		ths = intersect_line_line(x1,x2, y1,y2)
-		
-		if ths:
-			t,h = ths[0]
-			if 0.0 <= t <= 1.0:
-			
-				r = (xp + t*xl, h)
-				if len(rs) == 0 or (rs and rs[-1] != r):
-					rs.append(r)
-		
-		xp += xl
-	
-	return rs
+	rs = zip((poly.cs[i] + ts * poly.ls[i])[hit].tolist(), hs[hit].tolist())
+	return dedup(list(rs))
 	
 
 
 
-
+	
 
 
 
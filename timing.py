@@ -0,0 +1,128 @@
+import time, json, functools, tracemalloc
+
+"""
+Per-stage instrumentation: wall time, call count and peak traced memory of named stages.
+
+Disabled by default; stage() then returns a shared no-op context manager and
+functions wrapped with timed() only pay one flag check per call.
+"""
+
+ENABLED = False
+
+# name -> [calls, seconds, peak bytes]
+stats = {}
+
+# running peaks of the stages entered and not yet exited
+peaks = []
+
+
+class Stage:
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		if tracemalloc.is_tracing():
+			if peaks:
+				peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+			tracemalloc.reset_peak()
+			peaks.append(tracemalloc.get_traced_memory()[0])
+		self.t = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		dt = time.perf_counter() - self.t
+		peak = 0
+		if tracemalloc.is_tracing():
+			peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+			if peaks:
+				peaks[-1] = max(peaks[-1], peak)
+
+		s = stats.setdefault(self.name, [0, 0.0, 0])
+		s[0] += 1
+		s[1] += dt
+		s[2] = max(s[2], peak)
+		return False
+
+
+class NullStage:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+NULL_STAGE = NullStage()
+
+
+def stage(name):
+	""" Context manager recording stage 'name when enabled """
+	if not ENABLED:
+		return NULL_STAGE
+	return Stage(name)
+
+
+def timed(name):
+	""" Decorator recording each call of the function as stage 'name """
+	def wrap(f):
+		@functools.wraps(f)
+		def g(*args, **kwargs):
+			if not ENABLED:
+				return f(*args, **kwargs)
+			with Stage(name):
+				return f(*args, **kwargs)
+		return g
+	return wrap
+
+
+def enable(memory=True):
+	""" Start recording; 'memory also traces allocations (slower) """
+	global ENABLED
+	ENABLED = True
+	if memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+
+
+def disable():
+	global ENABLED
+	ENABLED = False
+	if tracemalloc.is_tracing():
+		tracemalloc.stop()
+
+
+def reset():
+	stats.clear()
+
+
+def get_report():
+	""" return -- {name: {'calls', 'seconds', 'peak_bytes'}} in order of first use """
+	return {
+		name: {'calls': c, 'seconds': t, 'peak_bytes': m}
+		for name, (c, t, m) in stats.items()
+	}
+
+
+def format_report():
+	"""
+	>>> reset(); stats['x'] = [2, 0.5, 2**20]
+	>>> print(format_report())
+	stage                      calls     time[s]    peak[MB]
+	x                              2      0.5000         1.0
+	>>> reset()
+	"""
+	lines = ["{:24} {:>7} {:>11} {:>11}".format('stage', 'calls', 'time[s]', 'peak[MB]')]
+	for name, (c, t, m) in stats.items():
+		lines.append("{:24} {:7} {:11.4f} {:11.1f}".format(name, c, t, m / 2**20))
+	return "\n".join(lines)
+
+
+def save_report(fname, fmt, extra=None):
+	""" Write the report as 'json or 'text
+	extra -- additional fields for the json report
+	"""
+	with open(fname, 'w') as f:
+		if fmt == 'json':
+			r = dict(extra or {})
+			r['stages'] = get_report()
+			json.dump(r, f, indent=1)
+		else:
+			f.write(format_report() + "\n")